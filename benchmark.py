@@ -0,0 +1,251 @@
+import json
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+from argparse import SUPPRESS, ArgumentParser
+
+# 各ステージの処理速度を、実データの代わりに決まった乱数で作った合成データで測る。
+#
+#   python benchmark.py                                  # 全ステージをワーカー数1,2,4で測り、benchmark-results/<リビジョン>.jsonに保存
+#   python benchmark.py --stages web --workers 1 4 --executors process thread
+#   python benchmark.py --compare benchmark-results/abc1234.json   # 以前の結果との比を表示
+#
+# 1回の計測ごとに新しいプロセスでprepare_datasetを読み込み、ステージの関数を実行する時間だけを測る。
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+STAGES = ("aozora", "web", "anthy", "cannadic")
+
+# ステージ名とprepare_dataset.SOURCESの名前が違うもの
+SOURCE_NAMES = {"cannadic": "alt-cannadic"}
+
+# (表記, 読み)。Sudachiにそれなりの仕事をさせるため、漢字・仮名・記号・数字を混ぜる
+WORDS = [
+    ("東京", "とうきょう"), ("大阪", "おおさか"), ("日本語", "にほんご"), ("学校", "がっこう"), ("先生", "せんせい"),
+    ("会社", "かいしゃ"), ("仕事", "しごと"), ("時間", "じかん"), ("今日", "きょう"), ("明日", "あした"),
+    ("天気", "てんき"), ("雨", "あめ"), ("研究所", "けんきゅうじょ"), ("大学", "だいがく"), ("病院", "びょういん"),
+    ("銀行", "ぎんこう"), ("温泉", "おんせん"), ("旅館", "りょかん"), ("問題", "もんだい"), ("自分", "じぶん"),
+    ("食べる", "たべる"), ("飲む", "のむ"), ("行く", "いく"), ("見る", "みる"), ("読む", "よむ"), ("書く", "かく"),
+    ("考える", "かんがえる"), ("分かる", "わかる"), ("思う", "おもう"), ("言う", "いう"), ("持つ", "もつ"),
+    ("の", "の"), ("は", "は"), ("が", "が"), ("を", "を"), ("に", "に"), ("へ", "へ"), ("と", "と"), ("で", "で"),
+    ("から", "から"), ("まで", "まで"), ("です", "です"), ("ます", "ます"), ("した", "した"), ("して", "して"),
+    ("ありがとう", "ありがとう"), ("やっぱり", "やっぱり"), ("ちょっと", "ちょっと"), ("とても", "とても"),
+    ("コンピューター", "こんぴゅーたー"), ("ブログ", "ぶろぐ"), ("ランキング", "らんきんぐ"), ("ニュース", "にゅーす"),
+    ("一", "いち"), ("三", "さん"), ("2010", "2010"), ("100", "100"), ("人", "ひと"), ("円", "えん"), ("年", "ねん"),
+    ("、", "、"), ("。", "。"), ("「", "「"), ("」", "」"), ("送料無料", "そうりょうむりょう"), ("会員登録", "かいいんとうろく"),
+    ("三軒茶屋", "さんげんぢゃや"), ("浅草寺", "せんそうじ"), ("堪忍袋", "かんにんぶくろ"), ("小一時間", "こいちじかん"),
+]
+
+
+def zipf_freq(rng, minimum):
+    # nwc2010のように、低頻度が多く高頻度が少ない分布
+    return int(minimum * (1 / (rng.random() + 1e-9)) ** 1.2)
+
+
+def generate_aozora(dirname, n_lines, n_files, rng):
+    # 「行番号:」で始まる文ごとに、表記\t読み\t種別 のトークン行が続く形式
+    os.makedirs(dirname, exist_ok=True)
+    for i in range(n_files):
+        with open(os.path.join(dirname, f"{i:04d}.txt"), "w", encoding="utf-8") as fp:
+            lines = 0
+            sentence = 0
+            while lines < n_lines // n_files:
+                fp.write(f"行番号:{sentence}\n[入力文]\t{sentence}\t[入力文]\n")
+                sentence += 1
+                for _ in range(rng.choice((3, 5, 8, 12, 20, 40))):
+                    surface, read = rng.choice(WORDS)
+                    if rng.random() < 0.01:
+                        read = ""
+                    fp.write(f"{surface}\t{read}\t{rng.choice(('通常', '通常', '分かち書き'))}\n")
+                    lines += 1
+                lines += 2
+
+
+def generate_web_ngram(dirname, n_lines, n_files, rng):
+    # 次数ごとの「n-gram\t頻度」のファイル。単語は空白区切り
+    os.makedirs(dirname, exist_ok=True)
+    orders = range(1, 8)
+    files_per_order = max(1, n_files // len(orders))
+    for order in orders:
+        for part in range(files_per_order):
+            with open(os.path.join(dirname, f"{order}gm-{part:04d}"), "w", encoding="utf-8") as fp:
+                for _ in range(n_lines // (len(orders) * files_per_order)):
+                    ngram = " ".join(rng.choice(WORDS)[0] for _ in range(order))
+                    fp.write(f"{ngram}\t{zipf_freq(rng, 100)}\n")
+
+
+def generate_anthy(dirname, n_lines, n_files, rng):
+    # |よみ|を|区切る| |表記|を|区切る| の形式。一部は先頭に列が1つ多い
+    os.makedirs(dirname, exist_ok=True)
+    for i in range(n_files):
+        with open(os.path.join(dirname, f"synthetic.{i}.txt"), "w", encoding="utf-8") as fp:
+            fp.write("# synthetic anthy corpus\n")
+            for _ in range(n_lines // n_files):
+                words = [rng.choice(WORDS) for _ in range(rng.randint(2, 10))]
+                read = "|" + "|".join(w[1] for w in words) + "|"
+                surface = "|" + "|".join(w[0] for w in words) + "|"
+                if rng.random() < 0.1:
+                    fp.write(f"x {read} {surface}\n")
+                else:
+                    fp.write(f"{read} {surface}\n")
+
+
+def generate_cannadic(dirname, n_lines, n_files, rng):
+    # よみ #品詞*頻度 表記 表記 ... の形式
+    os.makedirs(dirname, exist_ok=True)
+    for i in range(n_files):
+        with open(os.path.join(dirname, f"gcanna{i}.ctd"), "w", encoding="utf-8") as fp:
+            for _ in range(n_lines // n_files):
+                surface, read = rng.choice(WORDS)
+                entries = [f"#{rng.choice(('T35', 'KY', 'JN', 'CN'))}*{rng.randint(1, 800)}"]
+                entries += [surface] * rng.randint(1, 3)
+                fp.write(f"{read} {' '.join(entries)}\n")
+
+
+# ステージ名 -> (生成関数, データのディレクトリ名, 既定の行数)
+GENERATORS = {
+    "aozora": (generate_aozora, "aozora_dataset", 200000),
+    "web": (generate_web_ngram, "japanese-web-ngram", 50000),
+    "anthy": (generate_anthy, "anthy-corpus", 50000),
+    "cannadic": (generate_cannadic, "alt-cannadic", 100000),
+}
+
+
+def generate(data_dir, stage, scale=1.0, n_files=8, seed=0):
+    # 同じ引数なら同じデータになる。生成済みならそのまま使う
+    func, subdir, n_lines = GENERATORS[stage]
+    dirname = os.path.join(data_dir, f"{subdir}-{scale:g}-{n_files}-{seed}")
+    if not os.path.isdir(dirname):
+        tmp = dirname + ".tmp"
+        func(tmp, int(n_lines * scale), n_files, random.Random(f"{stage}:{seed}"))
+        os.replace(tmp, dirname)
+    return dirname
+
+
+def input_size(dirname):
+    n_lines = 0
+    n_bytes = 0
+    for root, _dirs, filenames in os.walk(top=dirname):
+        for filename in filenames:
+            with open(os.path.join(root, filename), "rb") as fp:
+                data = fp.read()
+            n_lines += data.count(b"\n")
+            n_bytes += len(data)
+    return n_lines, n_bytes
+
+
+def run_stage(stage, dirname, workers, executor):
+    # 新しいプロセスの中で呼ばれる。ステージの実行時間とピークRSSを返す
+    sys.path.insert(0, REPO_DIR)
+    import prepare_dataset
+
+    with tempfile.TemporaryDirectory() as output_dir:
+        metrics_file = os.path.join(output_dir, "metrics.json")
+        options = prepare_dataset.PipelineOptions(processes=workers, executor=executor, metrics_file=metrics_file)
+
+        t = time.perf_counter()
+        prepare_dataset.run_source(prepare_dataset.SOURCES[SOURCE_NAMES.get(stage, stage)], dirname, output_dir, options)
+        seconds = time.perf_counter() - t
+
+        # ワーカーを含めた合計(metrics_file)と、このプロセスのピークRSSの大きいほう
+        peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+        if os.path.exists(metrics_file):
+            with open(metrics_file) as fp:
+                peak_rss = max(peak_rss, json.load(fp)["peak_rss"])
+
+    return {"seconds": seconds, "peak_rss": peak_rss}
+
+
+def measure(stage, dirname, workers, executor):
+    with tempfile.NamedTemporaryFile(suffix=".json") as out:
+        # ステータス行などは捨て、失敗したときだけ表示する
+        r = subprocess.run([sys.executable, os.path.abspath(__file__), "--run-stage", stage, dirname, str(workers), executor, out.name],
+                           stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+        if r.returncode != 0:
+            sys.stderr.write(r.stderr)
+            r.check_returncode()
+        with open(out.name) as fp:
+            return json.load(fp)
+
+
+def revision():
+    rev = subprocess.run(["git", "-C", REPO_DIR, "rev-parse", "--short", "HEAD"], capture_output=True, text=True).stdout.strip() or "unknown"
+    dirty = subprocess.run(["git", "-C", REPO_DIR, "status", "--porcelain", "--untracked-files=no"], capture_output=True, text=True).stdout.strip()
+    return rev + ("-dirty" if dirty else "")
+
+
+def format_row(row):
+    return (f"{row['stage']:<9} {row['executor']:<8} {row['workers']:>7} {row['lines']:>10,} {row['lines_per_sec']:>12,.0f} "
+            f"{row['mb_per_sec']:>8.2f} {row['peak_rss'] / 2**20:>10,.0f}")
+
+
+def main():
+    arg_parser = ArgumentParser(description="benchmark every stage on deterministic synthetic data")
+    arg_parser.add_argument("--stages", nargs="+", default=list(STAGES), choices=STAGES, help="stages to benchmark")
+    arg_parser.add_argument("--workers", nargs="+", default=[1, 2, 4], type=int, help="worker counts to try")
+    arg_parser.add_argument("--executors", nargs="+", default=["process"], choices=("process", "thread"), help="executors to try")
+    arg_parser.add_argument("--scale", default=1.0, type=float, help="multiply the default input size of every stage")
+    arg_parser.add_argument("--files", default=8, type=int, help="input files per stage")
+    arg_parser.add_argument("--seed", default=0, type=int, help="seed of the synthetic data")
+    arg_parser.add_argument("--data-dir", default=os.path.join(tempfile.gettempdir(), "im-corpus-benchmark"), type=str,
+                            help="where to cache the generated data")
+    arg_parser.add_argument("--output", default=None, type=str, help="results file (default: benchmark-results/<revision>.json)")
+    arg_parser.add_argument("--compare", default=None, type=str, help="previous results file to compare lines/sec against")
+    arg_parser.add_argument("--run-stage", nargs=5, default=None, help=SUPPRESS)
+    args = arg_parser.parse_args()
+
+    if args.run_stage:
+        stage, dirname, workers, executor, output = args.run_stage
+        result = run_stage(stage, dirname, int(workers), executor)
+        with open(output, "w") as fp:
+            json.dump(result, fp)
+        return
+
+    rev = revision()
+    results = []
+    print(f"{'stage':<9} {'executor':<8} {'workers':>7} {'lines':>10} {'lines/s':>12} {'MB/s':>8} {'peak MB':>10}")
+    for stage in args.stages:
+        dirname = generate(args.data_dir, stage, args.scale, args.files, args.seed)
+        n_lines, n_bytes = input_size(dirname)
+        for executor in args.executors:
+            for workers in args.workers:
+                m = measure(stage, dirname, workers, executor)
+                row = {
+                    "stage": stage,
+                    "executor": executor,
+                    "workers": workers,
+                    "lines": n_lines,
+                    "bytes": n_bytes,
+                    "seconds": m["seconds"],
+                    "lines_per_sec": n_lines / m["seconds"],
+                    "mb_per_sec": n_bytes / m["seconds"] / 1e6,
+                    "peak_rss": m["peak_rss"],
+                }
+                results.append(row)
+                print(format_row(row), flush=True)
+
+    output = args.output or os.path.join(REPO_DIR, "benchmark-results", f"{rev}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, "w") as fp:
+        json.dump({"revision": rev, "time": time.time(), "cpu_count": os.cpu_count(), "scale": args.scale, "seed": args.seed, "results": results}, fp, indent=1)
+    print(f"results written to {output}")
+
+    if args.compare:
+        with open(args.compare) as fp:
+            previous = json.load(fp)
+        before = {(r["stage"], r["executor"], r["workers"]): r for r in previous["results"]}
+        print(f"compared with {previous['revision']} (lines/s ratio, >1 is faster)")
+        if previous.get("scale") != args.scale or previous.get("seed") != args.seed:
+            print("warning: the previous results were measured on different synthetic data")
+        for row in results:
+            old = before.get((row["stage"], row["executor"], row["workers"]))
+            if old is not None:
+                print(f"{row['stage']:<9} {row['executor']:<8} {row['workers']:>7} {row['lines_per_sec'] / old['lines_per_sec']:>8.2f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,468 @@
+import array
+import gzip
+import json
+import lzma
+import os
+import queue
+import struct
+import sys
+import threading
+from argparse import ArgumentParser
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import NamedTuple
+
+OUTPUT_FORMATS = ("jsonl", "binary")
+COMPRESSIONS = ("none", "gzip", "xz")
+
+COMPRESSION_SUFFIXES = {"gzip": ".gz", "xz": ".xz"}
+GZIP_MAGIC = b"\x1f\x8b"
+XZ_MAGIC = b"\xfd7zXZ\x00"
+
+# バイナリ形式(im corpus binary)
+#
+# ファイル先頭: BINARY_MAGIC + バージョン(1byte)
+# 以降はブロックの繰り返し: <payloadのbyte数:u32><レコード数:u32><payload>
+# payloadは以下の列を長さ付き(<byte数:u32>)で順に並べたもの
+#   文字列長(u32[]), 文字列本体(utf-8), フィールドmask(u8[]),
+#   surfaceのトークン数(u32[]), readのトークン数(u32[]),
+#   surfaceの文字列id(u32[]), readの文字列id(u32[]), freq(i64[]), score(i64[])
+# トークン数の列はトークン列のレコードの分だけ、freq/scoreは値を持つレコードの分だけ並ぶ。
+# 文字列テーブルはブロック内で共有される。
+BINARY_MAGIC = b"IMCB"
+BINARY_VERSION = 1
+BINARY_SUFFIX = ".imcb"
+
+HAS_SURFACE = 1
+HAS_READ = 2
+HAS_FREQ = 4
+HAS_SCORE = 8
+IS_TOKENS = 16
+
+_BLOCK_HEADER = struct.Struct("<II")
+_LENGTH = struct.Struct("<I")
+
+RECORD_KEYS = ("surface", "read", "freq", "score")
+
+
+# ワーカーの結果として大量に保持・pickleされるので、レコードはdictではなくtupleで持ち、
+# 書き出すときにだけdictに変換する。
+class WebEntry(NamedTuple):
+    surface: str
+    read: str
+    freq: int
+    score: int | None = None
+
+    def as_dict(self):
+        if self.score is None:
+            return {"surface": self.surface, "read": self.read, "freq": self.freq}
+        return {"surface": self.surface, "read": self.read, "freq": self.freq, "score": self.score}
+
+
+class DictEntry(NamedTuple):
+    surface: str
+    read: str
+    score: int
+
+    def as_dict(self):
+        return {"surface": self.surface, "read": self.read, "score": self.score}
+
+
+# トークン列はタブ区切りの1つの文字列として持つ(トークンにタブは含まれない)。空の列はNone。
+TOKEN_SEPARATOR = "\t"
+
+
+class TokenSentence(NamedTuple):
+    surface: str | None
+    read: str | None
+
+    @classmethod
+    def from_tokens(cls, surface, read):
+        return cls(TOKEN_SEPARATOR.join(surface) if surface else None, TOKEN_SEPARATOR.join(read) if read else None)
+
+    def surface_tokens(self):
+        return self.surface.split(TOKEN_SEPARATOR) if self.surface is not None else []
+
+    def read_tokens(self):
+        return self.read.split(TOKEN_SEPARATOR) if self.read is not None else []
+
+    def as_dict(self):
+        return {"surface": self.surface_tokens(), "read": self.read_tokens()}
+
+
+def record_dict(record):
+    if type(record) is dict:
+        return record
+    return record.as_dict()
+
+
+def output_filename(output_file, output_format, compression="none"):
+    if output_format == "binary":
+        output_file = os.path.splitext(output_file)[0] + BINARY_SUFFIX
+    return output_file + COMPRESSION_SUFFIXES.get(compression, "")
+
+
+def _pack_column(column):
+    if isinstance(column, array.array):
+        if sys.byteorder == "big":
+            column = array.array(column.typecode, column)
+            column.byteswap()
+        column = column.tobytes()
+    return _LENGTH.pack(len(column)) + column
+
+
+def _unpack_column(payload, offset, typecode=None):
+    (size,) = _LENGTH.unpack_from(payload, offset)
+    offset += _LENGTH.size
+    data = payload[offset:offset + size]
+    if typecode is not None:
+        column = array.array(typecode)
+        column.frombytes(data)
+        if sys.byteorder == "big":
+            column.byteswap()
+        data = column
+    return data, offset + size
+
+
+def _compress_gzip(data, level):
+    return gzip.compress(data, compresslevel=level, mtime=0)
+
+
+def _compress_xz(data, level):
+    return lzma.compress(data, format=lzma.FORMAT_XZ, preset=level)
+
+
+# 出力を独立に圧縮したブロック(gzipのmember / xzのstream)に分けて並列に圧縮し、順番通りに連結する。
+# 連結結果はgzip/xzコマンドやgzip.open/lzma.openでそのまま読める。
+# zlib/lzmaは圧縮中にGILを解放するので、スレッドで複数コアを使える。
+class BlockCompressedFile:
+    def __init__(self, fp, compression, block_size=4 << 20, workers=None, level=None):
+        if compression == "gzip":
+            self.compress = _compress_gzip
+            self.level = 6 if level is None else level
+        elif compression == "xz":
+            self.compress = _compress_xz
+            self.level = 6 if level is None else level
+        else:
+            raise ValueError(f"unknown compression: {compression}")
+
+        self.fp = fp
+        self.block_size = block_size
+        self.workers = workers or os.cpu_count() or 1
+        self.executor = ThreadPoolExecutor(self.workers)
+        self.pending = deque()
+        self.buffer = []
+        self.buffered = 0
+
+    def write(self, data):
+        self.buffer.append(data)
+        self.buffered += len(data)
+        if self.buffered >= self.block_size:
+            self._submit()
+
+    def _submit(self):
+        data = b"".join(self.buffer)
+        self.buffer = []
+        self.buffered = 0
+        self.pending.append(self.executor.submit(self.compress, data, self.level))
+
+        # 圧縮待ちのブロックが溜まりすぎないように、先頭から順に書き出す
+        while len(self.pending) > self.workers * 2:
+            self.fp.write(self.pending.popleft().result())
+
+    def close(self):
+        if self.buffered:
+            self._submit()
+        while self.pending:
+            self.fp.write(self.pending.popleft().result())
+        self.executor.shutdown()
+        self.fp.close()
+
+
+def open_compressed(path):
+    fp = open(path, "rb")
+    magic = fp.read(len(XZ_MAGIC))
+    fp.seek(0)
+    if magic.startswith(GZIP_MAGIC):
+        return gzip.open(fp)
+    elif magic == XZ_MAGIC:
+        return lzma.open(fp)
+    return fp
+
+
+class JsonlRecordWriter:
+    def __init__(self, fp):
+        self.fp = fp
+
+    def write(self, record):
+        self.fp.write((json.dumps(record_dict(record), ensure_ascii=False) + "\n").encode("utf-8"))
+
+    def write_batch(self, records):
+        self.fp.write("".join([json.dumps(record_dict(r), ensure_ascii=False) + "\n" for r in records]).encode("utf-8"))
+
+    def close(self):
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class BinaryRecordWriter:
+    def __init__(self, fp, block_records=65536):
+        self.fp = fp
+        self.block_records = block_records
+        self.fp.write(BINARY_MAGIC + bytes([BINARY_VERSION]))
+        self._reset()
+
+    def _reset(self):
+        self.strings = {}
+        self.masks = bytearray()
+        self.surface_counts = array.array("I")
+        self.read_counts = array.array("I")
+        self.surface_ids = array.array("I")
+        self.read_ids = array.array("I")
+        self.freqs = array.array("q")
+        self.scores = array.array("q")
+
+    def _intern(self, s):
+        i = self.strings.get(s)
+        if i is None:
+            i = self.strings[s] = len(self.strings)
+        return i
+
+    def write(self, record):
+        record = record_dict(record)
+        for key in record:
+            if key not in RECORD_KEYS:
+                raise ValueError(f"unsupported record key: {key}")
+
+        surface = record.get("surface")
+        read = record.get("read")
+        mask = 0
+
+        if isinstance(surface, str) or isinstance(read, str):
+            if not (surface is None or isinstance(surface, str)) or not (read is None or isinstance(read, str)):
+                raise ValueError("surface and read must both be strings or both be token lists")
+            if surface is not None:
+                mask |= HAS_SURFACE
+                self.surface_ids.append(self._intern(surface))
+            if read is not None:
+                mask |= HAS_READ
+                self.read_ids.append(self._intern(read))
+        elif surface is not None or read is not None:
+            mask |= IS_TOKENS
+            if surface is not None:
+                mask |= HAS_SURFACE
+                self.surface_counts.append(len(surface))
+                self.surface_ids.extend(self._intern(x) for x in surface)
+            if read is not None:
+                mask |= HAS_READ
+                self.read_counts.append(len(read))
+                self.read_ids.extend(self._intern(x) for x in read)
+
+        if "freq" in record:
+            mask |= HAS_FREQ
+            self.freqs.append(record["freq"])
+        if "score" in record:
+            mask |= HAS_SCORE
+            self.scores.append(record["score"])
+
+        self.masks.append(mask)
+        if len(self.masks) >= self.block_records:
+            self.flush()
+
+    def write_batch(self, records):
+        for record in records:
+            self.write(record)
+
+    def flush(self):
+        if not self.masks:
+            return
+
+        encoded = [s.encode("utf-8") for s in self.strings]
+        payload = b"".join([
+            _pack_column(array.array("I", [len(x) for x in encoded])),
+            _pack_column(b"".join(encoded)),
+            _pack_column(bytes(self.masks)),
+            _pack_column(self.surface_counts),
+            _pack_column(self.read_counts),
+            _pack_column(self.surface_ids),
+            _pack_column(self.read_ids),
+            _pack_column(self.freqs),
+            _pack_column(self.scores),
+        ])
+        self.fp.write(_BLOCK_HEADER.pack(len(payload), len(self.masks)))
+        self.fp.write(payload)
+        self._reset()
+
+    def close(self):
+        self.flush()
+        self.fp.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+# レコードのシリアライズと書き込みを別スレッドで行う。
+# キューの長さに上限があるので、書き込みが追いつかないときはput()がブロックして呼び出し側が待たされる。
+class BackgroundRecordWriter:
+    def __init__(self, writer, max_batches=16):
+        self.writer = writer
+        self.queue = queue.Queue(max_batches)
+        self.error = None
+        self.thread = threading.Thread(target=self._run, name="record-writer", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        while True:
+            batch = self.queue.get()
+            if batch is None:
+                break
+            if self.error is not None:
+                continue
+            try:
+                self.writer.write_batch(batch)
+            except BaseException as e:
+                self.error = e
+
+    def put(self, records):
+        if self.error is not None:
+            raise self.error
+        if records:
+            self.queue.put(records)
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+        self.writer.close()
+        if self.error is not None:
+            raise self.error
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_record_writer(path, output_format="jsonl", compression="none", compress_workers=None):
+    if output_format not in OUTPUT_FORMATS:
+        raise ValueError(f"unknown output format: {output_format}")
+
+    fp = open(path, "wb")
+    if compression != "none":
+        fp = BlockCompressedFile(fp, compression, workers=compress_workers)
+
+    if output_format == "jsonl":
+        return JsonlRecordWriter(fp)
+    return BinaryRecordWriter(fp)
+
+
+def _decode_block(payload, n):
+    lengths, offset = _unpack_column(payload, 0, "I")
+    blob, offset = _unpack_column(payload, offset)
+    masks, offset = _unpack_column(payload, offset)
+    surface_counts, offset = _unpack_column(payload, offset, "I")
+    read_counts, offset = _unpack_column(payload, offset, "I")
+    surface_ids, offset = _unpack_column(payload, offset, "I")
+    read_ids, offset = _unpack_column(payload, offset, "I")
+    freqs, offset = _unpack_column(payload, offset, "q")
+    scores, offset = _unpack_column(payload, offset, "q")
+
+    strings = []
+    pos = 0
+    for length in lengths:
+        strings.append(blob[pos:pos + length].decode("utf-8"))
+        pos += length
+
+    surface_pos = read_pos = 0
+    surface_count_pos = read_count_pos = 0
+    freq_pos = score_pos = 0
+
+    for i in range(n):
+        mask = masks[i]
+        record = {}
+        if mask & IS_TOKENS:
+            if mask & HAS_SURFACE:
+                count = surface_counts[surface_count_pos]
+                surface_count_pos += 1
+                record["surface"] = [strings[x] for x in surface_ids[surface_pos:surface_pos + count]]
+                surface_pos += count
+            if mask & HAS_READ:
+                count = read_counts[read_count_pos]
+                read_count_pos += 1
+                record["read"] = [strings[x] for x in read_ids[read_pos:read_pos + count]]
+                read_pos += count
+        else:
+            if mask & HAS_SURFACE:
+                record["surface"] = strings[surface_ids[surface_pos]]
+                surface_pos += 1
+            if mask & HAS_READ:
+                record["read"] = strings[read_ids[read_pos]]
+                read_pos += 1
+        if mask & HAS_FREQ:
+            record["freq"] = freqs[freq_pos]
+            freq_pos += 1
+        if mask & HAS_SCORE:
+            record["score"] = scores[score_pos]
+            score_pos += 1
+        yield record
+
+
+def iter_binary_records(fp):
+    header = fp.read(len(BINARY_MAGIC) + 1)
+    if header[:len(BINARY_MAGIC)] != BINARY_MAGIC:
+        raise ValueError("not a binary corpus file")
+    if header[len(BINARY_MAGIC)] != BINARY_VERSION:
+        raise ValueError(f"unsupported binary corpus version: {header[len(BINARY_MAGIC)]}")
+
+    while True:
+        head = fp.read(_BLOCK_HEADER.size)
+        if not head:
+            break
+        if len(head) < _BLOCK_HEADER.size:
+            raise ValueError("truncated block header")
+        size, n = _BLOCK_HEADER.unpack(head)
+        payload = fp.read(size)
+        if len(payload) < size:
+            raise ValueError("truncated block")
+        yield from _decode_block(payload, n)
+
+
+def iter_records(path):
+    with open_compressed(path) as fp:
+        if fp.read(len(BINARY_MAGIC)) == BINARY_MAGIC:
+            fp.seek(0)
+            yield from iter_binary_records(fp)
+            return
+
+        fp.seek(0)
+        for line in fp:
+            line = line.strip()
+            if line:
+                yield json.loads(line)
+
+
+def convert_to_jsonl(src, dst):
+    with open_record_writer(dst, "jsonl") as writer:
+        for record in iter_records(src):
+            writer.write(record)
+
+
+def main():
+    arg_parser = ArgumentParser(description="convert a corpus file (binary or jsonl, optionally gzip/xz compressed) to jsonl")
+    arg_parser.add_argument("input", type=str, help="input corpus file")
+    arg_parser.add_argument("output", type=str, help="output jsonl file")
+    args = arg_parser.parse_args()
+
+    convert_to_jsonl(args.input, args.output)
+
+
+if __name__ == "__main__":
+    main()
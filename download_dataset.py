@@ -0,0 +1,372 @@
+import hashlib
+import logging
+import lzma
+import os
+import shutil
+import sys
+import threading
+import time
+import zipfile
+from argparse import ArgumentParser
+from concurrent.futures import Future, ThreadPoolExecutor, as_completed
+from dataclasses import dataclass
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+# データセットのダウンロード。複数のファイルを並列に取得し、途中で切れたファイルはRangeリクエストで続きから取り直す。
+# 取得したファイルはサイズ(Content-Length)と、指定があればsha256で確かめてから展開する。
+# 展開まで済んだファイルは、次回からネットワークにアクセスせずに飛ばす。
+
+NDL_BASE_URL = "https://lab.ndl.go.jp/dataset/huriganacorpus"
+NWC_FILELIST_URL = "https://s3-ap-northeast-1.amazonaws.com/nwc2010-ngrams/word/over99/filelist"
+
+logger = logging.getLogger("download_dataset")
+
+
+class DownloadError(Exception):
+    pass
+
+
+@dataclass
+class DownloadTask:
+    url: str
+    path: str
+    # "zip"ならextract_dirに展開、"xz"なら.xzを外したファイルに展開して.xzを消す
+    extract: str | None = None
+    extract_dir: str | None = None
+    sha256: str | None = None
+
+    @property
+    def output(self):
+        # 展開後のファイルまたはディレクトリ
+        if self.extract == "xz":
+            return self.path.removesuffix(".xz")
+        if self.extract == "zip":
+            return self.extract_dir
+        return self.path
+
+    @property
+    def done_marker(self):
+        # zipは展開後も残すので、展開済みかどうかを別のファイルで記録する
+        return os.path.join(self.extract_dir, f".{os.path.basename(self.path)}.extracted")
+
+
+def sha256_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as fp:
+        for chunk in iter(lambda: fp.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def remote_size(url, timeout=60):
+    with urlopen(Request(url, method="HEAD"), timeout=timeout) as r:
+        size = r.headers.get("Content-Length")
+    return int(size) if size is not None else None
+
+
+def _total_size(response, offset):
+    # 206ならContent-Range: bytes a-b/total、200ならContent-Lengthから全体のサイズを得る
+    content_range = response.headers.get("Content-Range")
+    if content_range and "/" in content_range and not content_range.endswith("/*"):
+        return int(content_range.rsplit("/", 1)[1])
+    length = response.headers.get("Content-Length")
+    return int(length) + offset if length is not None else None
+
+
+def fetch(task, retries=5, timeout=60, chunk_size=1 << 20):
+    # task.urlをtask.path + ".part"に書き、サイズとsha256を確かめてからtask.pathにする。
+    # 失敗したら".part"の続きからretries回まで取り直す
+    part = task.path + ".part"
+    os.makedirs(os.path.dirname(os.path.abspath(task.path)), exist_ok=True)
+
+    for attempt in range(retries + 1):
+        try:
+            offset = os.path.getsize(part) if os.path.exists(part) else 0
+            headers = {"Range": f"bytes={offset}-"} if offset else {}
+            try:
+                response = urlopen(Request(task.url, headers=headers), timeout=timeout)
+            except HTTPError as e:
+                if e.code != 416:
+                    raise
+                # 要求した位置がファイルの末尾より後ろ。".part"が壊れているので最初から取り直す
+                os.remove(part)
+                raise DownloadError(f"{task.url}: range not satisfiable at {offset}") from e
+
+            with response:
+                if offset and response.status != 206:
+                    # Rangeに対応していないサーバーなので最初から
+                    offset = 0
+                total = _total_size(response, offset)
+                with open(part, "ab" if offset else "wb") as fp:
+                    shutil.copyfileobj(response, fp, chunk_size)
+
+            size = os.path.getsize(part)
+            if total is not None and size != total:
+                raise DownloadError(f"{task.url}: got {size} of {total} bytes")
+            if task.sha256 is not None and sha256_file(part) != task.sha256:
+                os.remove(part)
+                raise DownloadError(f"{task.url}: sha256 mismatch")
+            os.replace(part, task.path)
+            return task.path
+        except (DownloadError, URLError, OSError) as e:
+            if attempt == retries:
+                raise DownloadError(f"{task.url}: giving up after {retries + 1} attempts: {e}") from e
+            wait = min(2 ** attempt, 60)
+            logger.warning("%s: %s, retrying in %ds", task.url, e, wait)
+            time.sleep(wait)
+
+
+def verify_existing(task, timeout=60):
+    # 取得済みのファイルが完全かどうか。sha256があればそれで、なければリモートのサイズと比べる
+    if task.sha256 is not None:
+        return sha256_file(task.path) == task.sha256
+    try:
+        size = remote_size(task.url, timeout)
+    except (URLError, OSError) as e:
+        logger.warning("%s: cannot check the remote size (%s), keeping the local file", task.url, e)
+        return True
+    return size is None or size == os.path.getsize(task.path)
+
+
+def extract(task):
+    if task.extract == "xz":
+        tmp = task.output + ".tmp"
+        with lzma.open(task.path) as src, open(tmp, "wb") as dst:
+            shutil.copyfileobj(src, dst, 1 << 20)
+        os.replace(tmp, task.output)
+        os.remove(task.path)
+    elif task.extract == "zip":
+        with zipfile.ZipFile(task.path) as z:
+            z.extractall(task.extract_dir)
+        with open(task.done_marker, "w"):
+            pass
+    return task.output
+
+
+def is_done(task):
+    if task.extract == "xz":
+        return os.path.exists(task.output) and not os.path.exists(task.path)
+    if task.extract == "zip":
+        return os.path.exists(task.done_marker)
+    return os.path.exists(task.path)
+
+
+def run_task(task, retries=5, timeout=60):
+    # 1ファイル分の取得から展開まで。展開後のパスを返す
+    if is_done(task):
+        logger.info("%s: already done", task.output)
+        return task.output
+
+    if os.path.exists(task.path) and verify_existing(task, timeout):
+        logger.info("%s: already downloaded", task.path)
+    else:
+        logger.info("downloading %s", task.url)
+        fetch(task, retries, timeout)
+    return extract(task)
+
+
+def download_all(tasks, jobs=4, retries=5, timeout=60):
+    # tasksを最大jobs個ずつ並列に処理し、終わった順に(task, 展開後のパス)を返す。
+    # 失敗したファイルがあれば、残りを最後まで処理してからDownloadErrorを投げる
+    failed = []
+    with ThreadPoolExecutor(jobs) as executor:
+        futures = {executor.submit(run_task, task, retries, timeout): task for task in tasks}
+        for future in as_completed(futures):
+            task = futures[future]
+            try:
+                output = future.result()
+            except DownloadError as e:
+                logger.error("%s", e)
+                failed.append(task)
+                continue
+            yield task, output
+    if failed:
+        raise DownloadError(f"{len(failed)} of {len(futures)} files failed: " + " ".join(t.url for t in failed))
+
+
+class DownloadPipeline:
+    # 取得と処理を重ねるためのもの。バックグラウンドでtasksを順に取得・展開し、終わったものから処理側に渡す。
+    # 取得済みでまだ処理側が受け取っていないファイルはmax_pending個まで(取得中のものを含む)で、
+    # それ以上は処理側が受け取るまで次の取得を始めない。
+    #
+    # 枠はtasksの順に確保するので、処理側はtasksの順にステージを進めること(前のステージのファイルが枠を
+    # 持ったままだと、後のステージのファイルがいつまでも取得されない)。
+    def __init__(self, tasks, max_pending=8, jobs=4, retries=5, timeout=60):
+        self.tasks = list(tasks)
+        self.futures = {task.url: Future() for task in self.tasks}
+        self.slots = threading.Semaphore(max(1, max_pending))
+        self.closing = threading.Event()
+        self.executor = ThreadPoolExecutor(jobs, thread_name_prefix="download")
+        self.retries = retries
+        self.timeout = timeout
+        self.thread = threading.Thread(target=self._dispatch, name="download-dispatch", daemon=True)
+
+    def _dispatch(self):
+        for task in self.tasks:
+            self.slots.acquire()
+            if self.closing.is_set():
+                return
+            self.executor.submit(self._run, task)
+
+    def _run(self, task):
+        future = self.futures[task.url]
+        try:
+            future.set_result(run_task(task, self.retries, self.timeout))
+        except Exception as e:
+            # 失敗したファイルは処理側が受け取らないので、ここで枠を返す
+            self.slots.release()
+            future.set_exception(e)
+
+    def wait(self, task):
+        # taskの取得と展開が済むまで待ち、展開後のパスを返す
+        output = self.futures[task.url].result()
+        self.slots.release()
+        return output
+
+    def outputs(self, tasks, ordered=False):
+        # tasksのうち取得と展開が済んだものから順に(orderedならtasksの順に)、展開後のパスを返す
+        if ordered:
+            for task in tasks:
+                yield self.wait(task)
+            return
+        futures = {self.futures[task.url]: task for task in tasks}
+        for future in as_completed(futures):
+            output = future.result()
+            self.slots.release()
+            yield output
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def close(self):
+        # 枠を1つ返して取得待ちの振り分けを起こし、終わるのを待ってから(shutdown後にsubmitしないように)止める
+        self.closing.set()
+        self.slots.release()
+        if self.thread.is_alive():
+            self.thread.join()
+        self.executor.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def read_checksums(path):
+    # sha256sumの出力形式("<sha256>  <ファイル名>")。ファイル名はURLの末尾と照合する
+    checksums = {}
+    with open(path) as fp:
+        for line in fp:
+            if line.strip() and not line.startswith("#"):
+                digest, name = line.split(maxsplit=1)
+                checksums[os.path.basename(name.strip().lstrip("*"))] = digest.lower()
+    return checksums
+
+
+def fetch_filelist(url, timeout=60, retries=5):
+    for attempt in range(retries + 1):
+        try:
+            with urlopen(url, timeout=timeout) as r:
+                return [line.strip() for line in r.read().decode("utf-8").splitlines() if line.strip()]
+        except (URLError, OSError) as e:
+            if attempt == retries:
+                raise DownloadError(f"{url}: {e}") from e
+            time.sleep(min(2 ** attempt, 60))
+
+
+def dataset_tasks(output_dir, ndl_base_url=NDL_BASE_URL, filelist_url=NWC_FILELIST_URL, checksums=None, timeout=60):
+    checksums = checksums or {}
+    tasks = []
+    for name in ("shosi_dataset.zip", "aozora_dataset.zip"):
+        tasks.append(DownloadTask(f"{ndl_base_url}/{name}", os.path.join(output_dir, name), "zip", output_dir, checksums.get(name)))
+
+    web_dir = os.path.join(output_dir, "japanese-web-ngram")
+    for url in fetch_filelist(filelist_url, timeout):
+        name = os.path.basename(url)
+        tasks.append(DownloadTask(url, os.path.join(web_dir, name), "xz" if name.endswith(".xz") else None, web_dir, checksums.get(name)))
+    return tasks
+
+
+class MirrorRequestHandler(SimpleHTTPRequestHandler):
+    # http.serverにRange: bytes=n-への対応を足したもの。手元のディレクトリを本物のサーバーの代わりにして
+    # 並列取得や途中からの再開を試すのに使う
+    def send_head(self):
+        range_header = self.headers.get("Range")
+        path = self.translate_path(self.path)
+        if not range_header or not range_header.startswith("bytes=") or not os.path.isfile(path):
+            return super().send_head()
+
+        size = os.path.getsize(path)
+        start = int(range_header.removeprefix("bytes=").split("-", 1)[0])
+        if start >= size:
+            self.send_response(416)
+            self.send_header("Content-Range", f"bytes */{size}")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return None
+        fp = open(path, "rb")
+        fp.seek(start)
+        self.send_response(206)
+        self.send_header("Content-Type", self.guess_type(path))
+        self.send_header("Content-Range", f"bytes {start}-{size - 1}/{size}")
+        self.send_header("Content-Length", str(size - start))
+        self.end_headers()
+        return fp
+
+    def log_message(self, format, *args):
+        logger.info("%s %s", self.address_string(), format % args)
+
+
+def serve_mirror(directory, port=8000):
+    # directoryを公開し、japanese-web-ngram/以下のファイルからfilelistを作る。
+    #   python download_dataset.py --serve mirror --port 8000
+    #   python download_dataset.py --ndl-base-url http://localhost:8000 --nwc-filelist-url http://localhost:8000/filelist
+    web_dir = os.path.join(directory, "japanese-web-ngram")
+    if os.path.isdir(web_dir):
+        with open(os.path.join(directory, "filelist"), "w") as fp:
+            for name in sorted(os.listdir(web_dir)):
+                fp.write(f"http://localhost:{port}/japanese-web-ngram/{name}\n")
+
+    def handler(*args, **kwargs):
+        return MirrorRequestHandler(*args, directory=directory, **kwargs)
+
+    with ThreadingHTTPServer(("", port), handler) as server:
+        logger.info("serving %s on port %d", directory, port)
+        server.serve_forever()
+
+
+def main():
+    arg_parser = ArgumentParser(description="download and extract the datasets used by prepare_dataset.py")
+    arg_parser.add_argument("--output", default="dataset", type=str, help="output directory")
+    arg_parser.add_argument("--jobs", default=4, type=int, help="parallel downloads")
+    arg_parser.add_argument("--retries", default=5, type=int, help="retries per file, resuming partial downloads")
+    arg_parser.add_argument("--timeout", default=60, type=float, help="socket timeout in seconds")
+    arg_parser.add_argument("--checksums", default=None, type=str, help="sha256sum-format file to verify downloads against")
+    arg_parser.add_argument("--ndl-base-url", default=NDL_BASE_URL, type=str, help="base URL of the aozora/shosi furigana corpus")
+    arg_parser.add_argument("--nwc-filelist-url", default=NWC_FILELIST_URL, type=str, help="URL of the nwc2010 n-gram file list")
+    arg_parser.add_argument("--serve", default=None, type=str, metavar="DIR", help="serve DIR as a local mirror with range support instead of downloading")
+    arg_parser.add_argument("--port", default=8000, type=int, help="port for --serve")
+    args = arg_parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(threadName)s %(name)s %(levelname)s: %(message)s")
+
+    if args.serve:
+        serve_mirror(args.serve, args.port)
+        return
+
+    checksums = read_checksums(args.checksums) if args.checksums else None
+    tasks = dataset_tasks(args.output, args.ndl_base_url, args.nwc_filelist_url, checksums, args.timeout)
+    try:
+        for _task, output in download_all(tasks, args.jobs, args.retries, args.timeout):
+            logger.info("%s: done", output)
+    except DownloadError as e:
+        logger.error("%s", e)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+import contextlib
+import io
+import json
+import os
+import random
+import re
+import subprocess
+import sys
+import tarfile
+import tempfile
+import time
+from argparse import SUPPRESS, ArgumentParser
+
+# 高速化の前後で出力が変わっていないかを確かめるためのハーネス。
+#
+#   python golden.py record   # dataset/から各ソースの入力の一部をgolden_samples/に切り出す
+#   python golden.py compare --reference main   # mainの実装と作業ツリーの実装を同じ入力で動かして比べる
+#
+# 基準の実装はgit archiveで取り出した別のツリーから、比べる実装と同じくサブプロセスで読み込む。
+# web n-gramの足切りや読みの修正は乱数を使うので、1行ごとに"{seed}:{行}"で乱数を初期化してから処理する。
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# ソース名 -> (dataset/以下のディレクトリ, 対象のファイル名のパターン)
+SOURCES = {
+    "web": ("japanese-web-ngram", r"\dgm-\d\d\d\d$"),
+    "shosi": ("shosi_dataset", r""),
+    "aozora": ("aozora_dataset", r""),
+    "anthy": ("anthy-corpus", r"\.txt$"),
+    "cannadic": ("alt-cannadic", r"\.ctd$"),
+}
+
+# main()と同じtoken_limit
+AOZORA_TOKEN_LIMITS = {"shosi": 11, "aozora": 32}
+
+
+def find_files(dirname, pattern):
+    files = []
+    for root, _dirs, filenames in os.walk(top=dirname):
+        for filename in filenames:
+            if re.search(pattern, filename):
+                files.append(os.path.join(root, filename))
+    return sorted(files)
+
+
+def read_excerpt(filename, n_lines, n_chunks):
+    # ファイル全体から均等に選んだn_chunks箇所で、続く行を合わせてn_lines行ほど読む
+    size = os.path.getsize(filename)
+    lines = []
+    with open(filename, "rb") as fp:
+        for k in range(n_chunks):
+            offset = size * k // n_chunks
+            fp.seek(offset)
+            if offset > 0:
+                fp.readline()
+            for _ in range(n_lines // n_chunks):
+                line = fp.readline()
+                if not line:
+                    break
+                lines.append(line)
+    return lines
+
+
+def record_samples(dataset_dir, samples_dir, n_lines=2000, n_files=8):
+    for source, (subdir, pattern) in SOURCES.items():
+        files = find_files(os.path.join(dataset_dir, subdir), pattern)
+        if source == "anthy":
+            # corpus.4.txtは変換誤りの記録なので、prepare_dataset.pyと同じく使わない
+            files = [f for f in files if os.path.basename(f) != "corpus.4.txt"]
+        if not files:
+            print(f"{source}: no input files, skipped", file=sys.stderr)
+            continue
+
+        # ファイルは全体から均等に選ぶ。web n-gram以外は文や辞書の項目の区切りを崩さないよう先頭から読む
+        files = files[::max(1, len(files) // n_files)][:n_files]
+        for filename in files:
+            if source == "web":
+                lines = read_excerpt(filename, n_lines, 20)
+            else:
+                with open(filename, "rb") as fp:
+                    lines = [line for _, line in zip(range(n_lines), fp, strict=False)]
+
+            dst = os.path.join(samples_dir, source, os.path.relpath(filename, os.path.join(dataset_dir, subdir)))
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            with open(dst, "wb") as fp:
+                fp.writelines(lines)
+        print(f"{source}: {len(files)} files", file=sys.stderr)
+
+
+def plain(record):
+    # 実装によってレコードがdictだったりNamedTupleだったりするので、JSONにできる形に揃える
+    if record is None:
+        return None
+    if not isinstance(record, dict):
+        record = record.as_dict()
+    return json.loads(json.dumps(record, ensure_ascii=False))
+
+
+def proc_web_line(impl, line, freq_threshold):
+    proc_line = getattr(impl, "proc_japanese_web_ngram_line", None)
+    if proc_line is not None:
+        return proc_line(line, freq_threshold)
+
+    # proc_japanese_web_ngram_line()がない古い実装
+    r = impl.parse_japanese_web_ngram_line(line, freq_threshold)
+    if not r:
+        return None
+    score = impl.calc_score(r)
+    if score < 20:
+        return None
+    if isinstance(r, dict):
+        r["score"] = score
+        return r
+    return r._replace(score=score)
+
+
+def run_source(impl, source, filename, seed):
+    # (レコードのキー, レコード)を返す
+    if source == "web":
+        freq_threshold = impl.calc_freq_threshold(filename)
+        with open(filename, encoding="utf-8") as fp:
+            for i, line in enumerate(fp):
+                line = line.rstrip()
+                random.seed(f"{seed}:{line}")
+                yield i, proc_web_line(impl, line, freq_threshold)
+        return
+
+    if source in AOZORA_TOKEN_LIMITS:
+        records = impl.proc_aozora_file(filename, token_limit=AOZORA_TOKEN_LIMITS[source])
+    elif source == "anthy":
+        records = impl.proc_anthy_file(filename)
+    else:
+        records = impl.proc_cannadic_file(filename)
+    yield from enumerate(records)
+
+
+def run_implementation(impl_dir, samples_dir, seed):
+    sys.path.insert(0, impl_dir)
+    with contextlib.redirect_stdout(io.StringIO()):
+        import prepare_dataset as impl
+
+    records = {}
+    timings = {}
+    for source in SOURCES:
+        files = find_files(os.path.join(samples_dir, source), r"")
+        if not files:
+            continue
+        elapsed = 0.0
+        for filename in files:
+            name = os.path.relpath(filename, samples_dir)
+            # 古い実装は処理中にprintするので捨てる
+            with contextlib.redirect_stdout(io.StringIO()):
+                t = time.perf_counter()
+                results = list(run_source(impl, source, filename, seed))
+                elapsed += time.perf_counter() - t
+            for key, record in results:
+                records[f"{name}:{key}"] = plain(record)
+        timings[source] = elapsed
+    return {"records": records, "timings": timings}
+
+
+def run_in_subprocess(impl_dir, samples_dir, seed):
+    # 基準と比較対象はどちらもprepare_datasetという名前なので、別々のプロセスで読み込む
+    with tempfile.NamedTemporaryFile(suffix=".json") as out:
+        subprocess.run([sys.executable, os.path.abspath(__file__), "run", impl_dir, samples_dir, out.name, "--seed", str(seed)], check=True)
+        with open(out.name, encoding="utf-8") as fp:
+            return json.load(fp)
+
+
+def export_revision(rev, dst):
+    archive = subprocess.run(["git", "-C", REPO_DIR, "archive", "--format=tar", rev], check=True, capture_output=True).stdout
+    with tarfile.open(fileobj=io.BytesIO(archive)) as tar:
+        tar.extractall(dst, filter="data")
+
+
+def compare(samples_dir, reference="HEAD", seed=0, max_diffs=20):
+    samples_dir = os.path.abspath(samples_dir)
+    with tempfile.TemporaryDirectory() as ref_dir:
+        export_revision(reference, ref_dir)
+        ref = run_in_subprocess(ref_dir, samples_dir, seed)
+    cur = run_in_subprocess(REPO_DIR, samples_dir, seed)
+
+    n_diffs = 0
+    for source in SOURCES:
+        if source not in cur["timings"]:
+            continue
+        prefix = source + os.sep
+        keys = sorted({k for k in ref["records"] if k.startswith(prefix)} | {k for k in cur["records"] if k.startswith(prefix)})
+        diffs = [k for k in keys if ref["records"].get(k) != cur["records"].get(k)]
+        n_diffs += len(diffs)
+
+        t_ref = ref["timings"].get(source, 0.0)
+        t_cur = cur["timings"][source]
+        print(f"{source}: {len(keys):,} records, {len(diffs):,} differ, reference {t_ref:.2f}s current {t_cur:.2f}s "
+              f"speed-up {t_ref / t_cur if t_cur else float('inf'):.2f}x")
+        for key in diffs[:max_diffs]:
+            print(f"  {key}")
+            print(f"    reference: {json.dumps(ref['records'].get(key), ensure_ascii=False)}")
+            print(f"    current:   {json.dumps(cur['records'].get(key), ensure_ascii=False)}")
+    return n_diffs
+
+
+def main():
+    arg_parser = ArgumentParser(description="golden-output differential test between a reference revision and the working tree")
+    commands = arg_parser.add_subparsers(dest="command", required=True)
+
+    record = commands.add_parser("record", help="copy excerpts of every source in the dataset into the samples directory")
+    record.add_argument("--dataset", default="dataset", type=str, help="dataset directory")
+    record.add_argument("--samples", default="golden_samples", type=str, help="samples directory")
+    record.add_argument("--lines", default=2000, type=int, help="lines per file")
+    record.add_argument("--files", default=8, type=int, help="files per source")
+
+    compare_ = commands.add_parser("compare", help="run the reference and current implementations on the samples and report differences")
+    compare_.add_argument("--samples", default="golden_samples", type=str, help="samples directory")
+    compare_.add_argument("--reference", default="HEAD", type=str, help="git revision of the reference implementation")
+    compare_.add_argument("--seed", default=0, type=int, help="seed for the per-line random state")
+    compare_.add_argument("--max-diffs", default=20, type=int, help="differences to print per source")
+
+    run = commands.add_parser("run", help=SUPPRESS)
+    run.add_argument("impl_dir", type=str)
+    run.add_argument("samples", type=str)
+    run.add_argument("output", type=str)
+    run.add_argument("--seed", default=0, type=int)
+
+    args = arg_parser.parse_args()
+
+    if args.command == "record":
+        record_samples(args.dataset, args.samples, args.lines, args.files)
+    elif args.command == "compare":
+        sys.exit(1 if compare(args.samples, args.reference, args.seed, args.max_diffs) else 0)
+    else:
+        result = run_implementation(os.path.abspath(args.impl_dir), args.samples, args.seed)
+        with open(args.output, "w", encoding="utf-8") as fp:
+            json.dump(result, fp, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    main()
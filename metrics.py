@@ -0,0 +1,245 @@
+import json
+import os
+import queue
+import resource
+import sys
+import threading
+import time
+from collections import Counter
+
+
+class RuleStats:
+    # ルールごとの 評価回数, 当たった回数(捨てた/適用した回数), 累積時間(ns)
+    def __init__(self):
+        self.entries = {}
+
+    def record(self, name, hit, elapsed_ns):
+        entry = self.entries.get(name)
+        if entry is None:
+            entry = self.entries[name] = [0, 0, 0]
+        entry[0] += 1
+        entry[1] += hit
+        entry[2] += elapsed_ns
+
+    def merge(self, entries):
+        for name, (evaluated, hits, elapsed_ns) in entries.items():
+            entry = self.entries.get(name)
+            if entry is None:
+                entry = self.entries[name] = [0, 0, 0]
+            entry[0] += evaluated
+            entry[1] += hits
+            entry[2] += elapsed_ns
+
+    def take(self):
+        entries = self.entries
+        self.entries = {}
+        return entries
+
+    def report(self):
+        groups = {}
+        for name, entry in self.entries.items():
+            group = name.split(".", 1)[0]
+            groups.setdefault(group, []).append((name, *entry))
+
+        lines = []
+        for group, rows in sorted(groups.items()):
+            total_ns = sum(row[3] for row in rows) or 1
+            rows.sort(key=lambda row: (-row[2], -row[3]))
+            lines.append(f"== {group} ({len(rows)} rules, ranked by hits) ==")
+            lines.append(f"{'rule':<40} {'evaluated':>12} {'hits':>12} {'hit%':>8} {'ms':>10} {'time%':>7} {'ns/eval':>9} {'hits/ms':>10}")
+            for name, evaluated, hits, elapsed_ns in rows:
+                ms = elapsed_ns / 1e6
+                lines.append(f"{name:<40} {evaluated:>12,} {hits:>12,} {hits / evaluated if evaluated else 0:>8.2%} {ms:>10.1f} "
+                             f"{elapsed_ns / total_ns:>7.1%} {elapsed_ns / evaluated if evaluated else 0:>9.0f} {hits / ms if ms else 0:>10.1f}")
+            lines.append("")
+        return "\n".join(lines)
+
+
+def current_rss():
+    # このプロセスの現在のRSS(バイト)。/procがなければ最大RSSで代用する
+    try:
+        with open("/proc/self/statm") as fp:
+            return int(fp.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+class WorkerMetrics(threading.local):
+    # ワーカー側のカウンタ。一定間隔ごとに差分をchannel経由で親プロセスに送る。
+    # スレッドで実行するときのために、インスタンスの状態はスレッドごとに持つ
+    def __init__(self, channel=None, interval=1.0):
+        self.channel = channel
+        self.interval = interval
+        self.counters = Counter()
+        self.rule_stats = None
+        self.last_flush = time.monotonic()
+
+    def record(self, name, hit, elapsed_ns):
+        # FilterCascade/ScoreChainsのinstrument()に渡せるよう、RuleStatsと同じ口を持つ
+        self.rule_stats.record(name, hit, elapsed_ns)
+
+    def maybe_flush(self):
+        if time.monotonic() - self.last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        self.last_flush = time.monotonic()
+        if self.channel is None:
+            return
+        rule_entries = self.rule_stats.take() if self.rule_stats is not None else None
+        if not self.counters and not rule_entries:
+            return
+        self.channel.put((os.getpid(), dict(self.counters), rule_entries, current_rss()))
+        self.counters.clear()
+
+
+# 各ワーカー(プロセス)に1つ。init_worker_metrics()でchannelが設定されるまでは何も送らない
+worker_metrics = WorkerMetrics()
+
+
+def init_worker_metrics(channel, interval=1.0, rule_stats=False):
+    worker_metrics.channel = channel
+    worker_metrics.interval = interval
+    worker_metrics.counters.clear()
+    worker_metrics.rule_stats = RuleStats() if rule_stats else None
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return f"{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}"
+
+
+class MetricsMonitor:
+    # ワーカーから送られてきたカウンタを集計し、1行のステータス表示と(指定があれば)JSONファイルに出力する
+    def __init__(self, channel, stage, total_bytes=None, interval=1.0, metrics_file=None, stream=sys.stderr):
+        self.channel = channel
+        self.stage = stage
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.metrics_file = metrics_file
+        self.stream = stream
+        self.is_tty = stream.isatty()
+        self.line_interval = 30.0
+        self.last_line = 0.0
+        self.totals = Counter()
+        self.rule_stats = RuleStats()
+        self.workers = set()
+        self.worker_rss = {}
+        self.retired = set()
+        self.peak_rss = 0
+        self.start_time = None
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, name="metrics-monitor", daemon=True)
+
+    def start(self):
+        self.start_time = time.monotonic()
+        self.thread.start()
+        return self
+
+    def _drain(self, timeout):
+        try:
+            pid, counters, rule_entries, rss = self.channel.get(timeout=timeout)
+        except queue.Empty:
+            return False
+        self.workers.add(pid)
+        if pid not in self.retired:
+            self.worker_rss[pid] = rss
+        self.totals.update(counters)
+        if rule_entries:
+            self.rule_stats.merge(rule_entries)
+        return True
+
+    def _run(self):
+        last_report = time.monotonic()
+        while not self.stopping.is_set():
+            self._drain(0.1)
+            now = time.monotonic()
+            if now - last_report >= self.interval:
+                last_report = now
+                self.report()
+
+    def retire_worker(self, pid):
+        # 終了したワーカーのRSSを合計から外す。まだchannelに残っているメッセージのRSSも無視する
+        if pid != os.getpid():
+            self.retired.add(pid)
+            self.worker_rss.pop(pid, None)
+
+    def total_rss(self):
+        # 親プロセスとワーカープロセスのRSSの合計。スレッド実行ではワーカーのpidが親と同じになる
+        pid = os.getpid()
+        return current_rss() + sum(rss for worker, rss in self.worker_rss.items() if worker != pid)
+
+    def snapshot(self):
+        elapsed = time.monotonic() - self.start_time
+        rss = self.total_rss()
+        self.peak_rss = max(self.peak_rss, rss)
+        lines = self.totals["lines"]
+        nbytes = self.totals["bytes"]
+        snapshot = {
+            "stage": self.stage,
+            "time": time.time(),
+            "elapsed": elapsed,
+            "workers": len(self.workers),
+            "counters": dict(self.totals),
+            "lines_per_sec": lines / elapsed if elapsed > 0 else 0.0,
+            "mb_per_sec": nbytes / elapsed / 1e6 if elapsed > 0 else 0.0,
+            # 1行から複数のレコードを作るソース(alt-cannadic)や、複数行で1レコードのソース(青空文庫)があるので、
+            # 採用率ではなく入力1行あたりの出力レコード数
+            "records_per_line": self.totals["accepted"] / lines if lines else 0.0,
+            "total_bytes": self.total_bytes,
+            "rss": rss,
+            "peak_rss": self.peak_rss,
+            "fast_path_ratio": self.totals["fast_path_hits"] / self.totals["filter_passed"] if self.totals["filter_passed"] else 0.0,
+            "eta": None,
+        }
+        if self.total_bytes and nbytes > 0:
+            snapshot["eta"] = max(self.total_bytes - nbytes, 0) / (nbytes / elapsed)
+        return snapshot
+
+    def status_line(self, snapshot):
+        counters = snapshot["counters"]
+        line = (f"[{self.stage}] {format_duration(snapshot['elapsed'])} "
+                f"{counters.get('lines', 0):,} lines {snapshot['lines_per_sec']:,.0f} lines/s "
+                f"{snapshot['mb_per_sec']:.1f} MB/s {snapshot['records_per_line']:.3f} records/line")
+        if counters.get("tokenize_calls"):
+            line += f" tokenize {counters['tokenize_calls']:,}"
+        if counters.get("fast_path_hits"):
+            line += f" fast path {snapshot['fast_path_ratio']:.1%}"
+        if counters.get("fast_path_mismatches"):
+            line += f" mismatches {counters['fast_path_mismatches']:,}"
+        line += f" RSS {snapshot['rss'] / 2**20:,.0f}MB"
+        if snapshot["eta"] is not None:
+            line += f" ETA {format_duration(snapshot['eta'])}"
+        return line
+
+    def report(self, final=False):
+        snapshot = self.snapshot()
+        line = self.status_line(snapshot)
+        if self.is_tty:
+            self.stream.write("\r\x1b[K" + line + ("\n" if final else ""))
+            self.stream.flush()
+        elif final or snapshot["elapsed"] - self.last_line >= self.line_interval:
+            # 端末でなければ上書きできないので、ログが埋まらないよう間隔をあけて1行ずつ出す
+            self.last_line = snapshot["elapsed"]
+            self.stream.write(line + "\n")
+            self.stream.flush()
+
+        if self.metrics_file:
+            tmp = self.metrics_file + ".tmp"
+            with open(tmp, "w") as fp:
+                json.dump(snapshot, fp)
+            os.replace(tmp, self.metrics_file)
+        return snapshot
+
+    def stop(self):
+        self.stopping.set()
+        self.thread.join()
+        while self._drain(0.1):
+            pass
+        return self.report(final=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
@@ -1,17 +1,103 @@
-import json
+import collections
+import contextlib
+import dataclasses
+import functools
+import itertools
+import logging
+import math
+import multiprocessing
 import os
+import queue
 import random
 import re
-import functools
-from argparse import ArgumentParser
+import shutil
+import threading
+import time
+import zlib
+from argparse import ArgumentParser, ArgumentTypeError
+from dataclasses import dataclass, field
 from multiprocessing import Pool
+from multiprocessing.pool import ThreadPool
+from typing import Callable, NamedTuple
 
 import jaconv
 import regex
-
 import sudachipy
 from sudachipy import dictionary as sudachidict
 
+import download_dataset
+from corpus_io import COMPRESSIONS, OUTPUT_FORMATS, BackgroundRecordWriter, DictEntry, TokenSentence, WebEntry, open_record_writer, output_filename
+from metrics import MetricsMonitor, current_rss, init_worker_metrics, worker_metrics
+from profiling import PROFILERS, Profiler, run_profiled, write_report
+from rule_engine import FilterCascade, FilterRule, ScoreChains, ScoreRule, TokenNormalizer, TokenRule
+
+logger = logging.getLogger("prepare_dataset")
+aozora_logger = logger.getChild("aozora")
+anthy_logger = logger.getChild("anthy")
+cannadic_logger = logger.getChild("cannadic")
+web_logger = logger.getChild("web")
+
+STAGE_LOGGERS = {
+    "aozora": aozora_logger,
+    "anthy": anthy_logger,
+    "cannadic": cannadic_logger,
+    "web": web_logger,
+    "download": download_dataset.logger,
+}
+
+
+def configure_logging(spec):
+    # "INFO" や "INFO,web=DEBUG" のように、全体とステージごとのログレベルを指定する。
+    # download_datasetのロガーはprepare_datasetの子ではないので、全体のレベルを先に両方に設定してからステージごとのレベルで上書きする
+    logging.basicConfig(format="%(asctime)s %(processName)s %(name)s %(levelname)s: %(message)s")
+    for item in sorted(spec.split(","), key=lambda item: "=" in item):
+        if not item:
+            continue
+        if "=" in item:
+            stage, level = item.split("=", 1)
+            if stage not in STAGE_LOGGERS:
+                raise ValueError(f"unknown stage: {stage}")
+            STAGE_LOGGERS[stage].setLevel(level.upper())
+        else:
+            logger.setLevel(item.upper())
+            download_dataset.logger.setLevel(item.upper())
+
+
+@dataclass
+class PipelineOptions:
+    output_format: str = "jsonl"
+    compression: str = "none"
+    metrics_file: str | None = None
+    rule_stats: str | None = None
+    adaptive_filters: bool = False
+    kana_fast_path: bool = False
+    verify_fast_path: bool = False
+    executor: str = "process"
+    processes: int | None = None
+    memory_budget: int | None = None
+    target_entries: int | None = None
+    sample: float | None = None
+    seed: int | None = None
+    profile: str | None = None
+    profile_dir: str = "profile"
+    ordered: bool = False
+
+
+class RateLimitedLogger:
+    # 進捗表示用。interval秒に1回までしか出力しない
+    def __init__(self, logger, interval=10.0, level=logging.INFO):
+        self.logger = logger
+        self.interval = interval
+        self.level = level
+        self.last = time.monotonic()
+
+    def log(self, msg, *args):
+        now = time.monotonic()
+        if now - self.last < self.interval:
+            return
+        self.last = now
+        self.logger.log(self.level, msg, *args)
+
 
 def is_hiragana(c) -> bool:
     if c == "ゝ" or c == "ゞ" or c == "々":
@@ -24,8 +110,12 @@ def is_katakana(c):
     return bool(pattern.match(c))
 
 
+# is_hiragana()が真になる文字だけ(空文字列を含む)
+_all_hiragana_pattern = re.compile("[\u3040-\u309c\u309f]*")
+
+
 def is_all_hiragana(s: str) -> bool:
-    return all(is_hiragana(c) for c in s)
+    return _all_hiragana_pattern.fullmatch(s) is not None
 
 
 def is_all_alphanumeric_hyphen(s: str) -> bool:
@@ -67,266 +157,587 @@ def is_kanji_or_katakana(c) -> bool:
     return False        
 
 
-def convert_token(token):
-    surface = token[0]
-    read = token[1]
+# 青空文庫・全国書誌のトークンの正規化。1文のトークン列に上から順に適用する
+AOZORA_TOKEN_RULES = [
+    TokenRule("read_override", "read_override", {
+        ("『", "」"): "「",
+        # 助詞の読みは表記のままにする
+        ("は", "わ"): "は",
+        ("を", "お"): "を",
+        ("へ", "え"): "へ",
+    }),
+    TokenRule("bracket", "surface_map", {"『": "「", "』": "」"}),
+    TokenRule("ha_words", "read_surface", {"あるいは", "もしくは", "または", "では", "それでは", "おそらくは", "ついては", "こんにちは"}),
+    TokenRule("choon", "read_translate", str.maketrans("ー", "う"), when=lambda surface, read: "ー" not in surface),
+    # たまにreadに空白が入っていることがある
+    TokenRule("space", "read_translate", str.maketrans("", "", " ")),
+    # ひらがなだけの表記は、読みも表記のままにする
+    TokenRule("hiragana", "read_surface", _all_hiragana_pattern),
+]
 
-    if surface == "『" and read == "」":
-        read = "「"
+normalize_aozora_tokens = TokenNormalizer(AOZORA_TOKEN_RULES)
 
-    if surface == "は" and read == "わ":
-        read = "は"
-    if surface == "を" and read == "お":
-        read = "を"
-    if surface == "へ" and read == "え":
-        read = "へ"
 
-    if surface == "『":
-        surface = "「"
-    elif surface == "』":
-        surface = "」"
+def convert_token(token):
+    # 1トークン分の正規化。tokenは[表記, 読み, ...]で、その場で書き換える
+    (token[0],), (token[1],) = normalize_aozora_tokens((token[0],), (token[1],))
+    return token
 
-    if surface in ["あるいは", "もしくは", "または", "もしくは", "では", "それでは", "おそらくは", "ついては", "こんにちは"]:
-        read = surface
 
-    if "ー" not in surface and "ー" in read:
-        read = read.replace("ー", "う")
+# 青空文庫・全国書誌のデータセットの文の区切り
+AOZORA_SENTENCE_MARK = "\n行番号:"
 
-    # たまにreadに空白が入っていることがある
-    read = read.replace(" ", "")
 
-    if is_all_hiragana(surface):
-#        if surface != read:
-#            print("r:", read, "s:", surface)
-        read = surface
+def _aozora_token(line):
+    # 「表記\t読み\t種別」の行を[表記, 読み, 種別]にする(正規化は文ごとにまとめてかける)。
+    # 文に入らない行はNone、表記か読みが空の行(その文は捨てる)はFalseを返す
+    ss = line.rstrip().split("\t")
+    if len(ss) < 3:
+        return None
 
-    token[0] = surface
-    token[1] = read
+    kind = ss[2]
+    if kind == "分かち書き" or kind == "[入力 読み]" or kind == "[入力文]":
+        return None
 
-    return token
+    if ss[1] == "" and ss[0] in ("(", ")"):
+        ss[1] = ss[0]
 
+    # どっちかが空になっている文は回復が難しい問題が含まれている割合が多いので捨てる
+    if ss[0] == "" or ss[1] == "":
+        return False
 
-def proc_aozora_file(filename, token_limit=11):
-    print(filename)
-    result = []
-    tokens = []
+    return ss
 
-    skip = False
 
-    for line in open(filename):
-        line = line.rstrip()
-        ss = line.split("\t")
+def _append_aozora_sentence(tokens, result):
+    surface, read, _ = zip(*tokens, strict=False)
+    surface, read = normalize_aozora_tokens(surface, read)
 
-        if line.startswith("行番号:"):
-            if skip:
-                skip = False
-                tokens = []
-            elif len(tokens) > 0 and len(tokens) < token_limit:
-                surface, read, _ = zip(*tokens)
+    if surface[-1] in {":", ".", "="}:
+        surface.pop()
+        read.pop()
 
-                if surface[-1] in {":", ".", "="}:
-                    surface = list(surface)
-                    read = list(read)
+    if surface[0] in {"総説", "特集"} or surface[-1] == "総説":
+        surface = []
+        read = []
 
-                    surface.pop()
-                    read.pop()
+    if len(surface) > 2:
+        result.append(TokenSentence.from_tokens(surface, read))
 
-                if surface[0] in {"総説", "特集"} or surface[-1] == "総説":
-                    surface = []
-                    read = []
 
-                if len(surface) > 2:
-                    sentence = {"surface": surface, "read": read}
-                    result.append(sentence)
+def _proc_aozora_tail(blocks, token_limit, result):
+    # 1行ずつ処理していたころと同じ規則で、blocksを区切りごとに処理する。
+    # 長すぎる文のトークンは区切りで捨てられずに次の文へ持ち越され、ファイルの最後に残ったトークンは
+    # (捨てる印の付いた文でも)24個未満ならそのまま1文になるので、その部分だけはこちらで処理する
+    tokens = []
+    skip = False
+    for k, block in enumerate(blocks):
+        if k > 0:
+            if skip:
+                skip = False
+                tokens = []
+            elif 0 < len(tokens) < token_limit:
+                _append_aozora_sentence(tokens, result)
                 tokens = []
-            continue
-
-        if len(ss) < 3:
-            continue
 
-        if ss[2] == "分かち書き":
-            continue
-        
-        if ss[1] == "" and ss[0] in ["(", ")"]:
-            ss[1] = ss[0]
+        for line in itertools.islice(block.split("\n"), 1, None):
+            token = _aozora_token(line)
+            if token is None:
+                continue
+            if token is False:
+                skip = True
+                continue
+            tokens.append(token)
 
-        if ss[2] == "[入力 読み]" or ss[2] == "[入力文]":
-            continue
+    if len(tokens) > 0:
+        surface, read, _ = zip(*tokens, strict=False)
+        if len(surface) < 24:
+            surface, read = normalize_aozora_tokens(surface, read)
+            result.append(TokenSentence.from_tokens(surface, read))
 
-        # どっちかが空になっている文は回復が難しい問題が含まれている割合が多いので捨てる
-        if ss[0] == "" or ss[1] == "":
-            skip = True
-            continue
 
-        ss = convert_token(ss)
-        tokens.append(ss)
+def proc_aozora_file(filename, token_limit=11):
+    # ファイルは1作品ずつで小さいので、まとめて読んで「行番号:」の区切りで文のブロックに分ける。
+    # 各ブロックの先頭の要素は区切りの行の残り(最初のブロックは空)で、続く要素がトークンの行になる。
+    # 表記か読みが空の行が出てきた文や、トークンがtoken_limitに達した文は、その時点でトークンを集めるのをやめる。
+    # トークンの正規化は、出力する文だけにまとめてかける
+    aozora_logger.debug("processing %s", filename)
+    result = []
 
-    if len(tokens) > 0:
-        surface, read, _ = zip(*tokens)
-        if len(surface) < 24:
-            sentence = {"surface": surface, "read": read}
-            result.append(sentence)
+    with open(filename, encoding="utf-8") as fp:
+        text = fp.read()
+    n_lines = text.count("\n") + (len(text) > 0 and not text.endswith("\n"))
+    blocks = ("\n" + text).split(AOZORA_SENTENCE_MARK)
+
+    # startはトークンが空の状態から溜め始めたブロック。overflowはtoken_limit以上溜まっていて、
+    # 捨てる印の付いた文が来るまで区切りでリセットされない状態
+    start = 0
+    overflow = False
+    for k in range(len(blocks) - 1):
+        limit = 0 if overflow else token_limit
         tokens = []
+        skip = False
+        for line in itertools.islice(blocks[k].split("\n"), 1, None):
+            token = _aozora_token(line)
+            if token is None:
+                continue
+            if token is False:
+                skip = True
+                break
+            if len(tokens) < limit:
+                tokens.append(token)
+
+        if skip:
+            overflow = False
+            start = k + 1
+        elif overflow or len(tokens) >= token_limit:
+            overflow = True
+        else:
+            if tokens:
+                _append_aozora_sentence(tokens, result)
+            start = k + 1
+
+    _proc_aozora_tail(blocks[start:], token_limit, result)
+
+    worker_metrics.counters.update(lines=n_lines, accepted=len(result), bytes=os.path.getsize(filename))
+    worker_metrics.flush()
 
     return result
 
 
-def proc_aozora_dataset(dirname, output_dir, output_file, token_limit=11):
+def imap_bounded(pool, func, iterable, max_pending, throttle=None, ordered=False):
+    # pool.imap_unordered()は全タスクを一度に投入するので、親の処理が遅れると結果がキューに溜まり続ける。
+    # ここでは未回収のタスクをmax_pending個までに制限し、結果を受け取ってから次のタスクを投入する。
+    # throttle()が真を返す間は、結果を1つ受け取ってから次を投入するので、実行中のタスクはそれ以上増えない。
+    # (プロセスのワーカーは手が空いてもRSSを持ったままなので、全部終わるのを待っても合計は下がらない)
+    # ordered=Trueなら、タスクに投入順の番号を付け、先に終わった結果はreorderバッファに置いて投入順に返す。
+    # バッファに置かれた結果も未回収に数えるので、バッファはmax_pending個を超えない
+    results = queue.Queue()
+    reorder = {}
+    next_seq = 0
+    pending = 0
+
+    def get():
+        nonlocal next_seq
+        while not ordered or next_seq not in reorder:
+            seq, ok, r = results.get()
+            if not ok:
+                raise r
+            if not ordered:
+                return r
+            reorder[seq] = r
+        next_seq += 1
+        return reorder.pop(next_seq - 1)
+
+    for seq, item in enumerate(iterable):
+        while pending >= max_pending:
+            yield get()
+            pending -= 1
+        if pending > 0 and throttle is not None and throttle():
+            yield get()
+            pending -= 1
+        pool.apply_async(func, (item,), callback=lambda r, seq=seq: results.put((seq, True, r)),
+                         error_callback=lambda e, seq=seq: results.put((seq, False, e)))
+        pending += 1
+
+    while pending > 0:
+        yield get()
+        pending -= 1
+
+
+def in_sample(key, fraction):
+    # keyのcrc32で選ぶので、同じfractionなら実行のたびに同じ部分集合になる。fractionがNoneなら全部
+    return fraction is None or zlib.crc32(key.encode("utf-8")) < fraction * 2**32
+
+
+def parse_fraction(text):
+    fraction = float(text)
+    if not 0 < fraction <= 1:
+        raise ArgumentTypeError(f"fraction must be in (0, 1]: {text}")
+    return fraction
+
+
+def parse_size(text):
+    # "512M" や "16G" のような指定をバイト数にする
+    m = re.fullmatch(r"(\d+(?:\.\d+)?)([KMGT]?)B?", text.strip().upper())
+    if m is None:
+        raise ArgumentTypeError(f"invalid size: {text}")
+    return int(float(m.group(1)) * 1024 ** " KMGT".index(m.group(2) or " "))
+
+
+def pool_class(options):
+    return ThreadPool if options.executor == "thread" else Pool
+
+
+# --memory-budgetのうち、ワーカーに使う割合。ワーカー数の見積もりと投入の抑制に同じ割合を使う
+MEMORY_BUDGET_RATIO = 0.9
+
+
+def run_measured(func, item):
+    # 1タスクを実行し、実行前と実行後(結果を持ったまま)のRSSと、実行したワーカーのpidを返す
+    before = current_rss()
+    result = func(item)
+    return result, before, current_rss(), os.getpid()
+
+
+def workers_for_budget(stage, func, item, writer, monitor, options):
+    # ワーカー1つで最初のタスクを処理してRSSを測り、予算(のMEMORY_BUDGET_RATIO)に収まるワーカー数を決める。
+    # プロセス実行ではワーカー1つのRSS全体、スレッド実行ではタスク中に増えた分がワーカー1つのコストになる
+    max_workers = options.processes or os.cpu_count() or 1
+    with pool_class(options)(1, initializer=init_worker, initargs=(monitor.channel, options)) as pool:
+        result, before, after, pid = pool.apply(run_measured, (func, item))
+    writer.put(result)
+    # 測定用のワーカーは終了したので、最後に送ってきたRSSを合計に含めない
+    monitor.retire_worker(pid)
+
+    if options.executor == "thread":
+        fixed, per_worker = before, after - before
+    else:
+        fixed, per_worker = current_rss(), after
+    budget = int(options.memory_budget * MEMORY_BUDGET_RATIO)
+    num_workers = max(1, min(max_workers, (budget - fixed) // max(per_worker, 1)))
+    logger.info("%s: %d workers fit in the memory budget of %dMB (%dMB per worker, %dMB fixed)",
+                stage, num_workers, options.memory_budget >> 20, per_worker >> 20, fixed >> 20)
+    return num_workers
+
+
+@contextlib.contextmanager
+def profile_stage(name, options):
+    # --profileの指定があれば、ステージの親プロセス側(直列のステージはすべて)とワーカーをプロファイルし、
+    # 終わったらprofile_dir/<name>/にまとめたレポートとflame graph用のスタックを書く
+    if not options.profile:
+        yield options
+        return
+
+    stage_dir = os.path.join(options.profile_dir, name)
+    shutil.rmtree(stage_dir, ignore_errors=True)
+    profiler = Profiler(options.profile, stage_dir, "main")
+    profiler.enable()
+    try:
+        yield dataclasses.replace(options, profile_dir=stage_dir)
+    finally:
+        profiler.disable()
+        profiler.dump()
+        report, stacks = write_report(stage_dir, name)
+        logger.info("%s: profile written to %s and %s", name, report, stacks)
+
+
+def open_output(output_dir, output_file, options):
     os.makedirs(output_dir, exist_ok=True)
-    output_file = os.path.join(output_dir, output_file)
+    output_file = os.path.join(output_dir, output_filename(output_file, options.output_format, options.compression))
+    return open_record_writer(output_file, options.output_format, options.compression)
+
+
+def init_worker(channel, options):
+    init_worker_metrics(channel, rule_stats=options.rule_stats is not None)
+    if worker_metrics.rule_stats is not None:
+        # worker_metricsはスレッドごとなので、スレッド実行でもルールの集計はスレッドごとに分かれる
+        web_ngram_filter.instrument(worker_metrics)
+        score_rules.instrument(worker_metrics)
+    global kana_fast_path, verify_fast_path
+    kana_fast_path = options.kana_fast_path or options.verify_fast_path
+    verify_fast_path = options.verify_fast_path
+
+
+def run_parallel_stage(stage, func, units, output, num_processes, options):
+    # ワーカーの結果をバックグラウンドで書き出しながら、進捗をワーカーから集計して表示する。
+    # executor="thread"では1プロセス内のスレッドで処理し、Sudachiの辞書を全ワーカーで共有する
+    # unitsはWorkUnitのリストか、--downloadで取得の済んだものから順に返すイテレータ(全体のサイズは分からない)
+    channel = queue.Queue() if options.executor == "thread" else multiprocessing.Queue()
+    total_bytes = sum(unit.size for unit in units) if isinstance(units, list) else None
+    num_processes = options.processes or num_processes
+    throttle = None
+
+    if options.profile:
+        func = functools.partial(run_profiled, options.profile, os.path.join(options.profile_dir, "workers"), func)
+
+    with MetricsMonitor(channel, stage, total_bytes, metrics_file=options.metrics_file) as monitor, BackgroundRecordWriter(output) as writer:
+        if options.memory_budget:
+            units = iter(units)
+            first = next(units, None)
+            if first is not None:
+                num_processes = workers_for_budget(stage, func, first, writer, monitor, options)
+
+            def throttle():
+                # 合計RSSが予算のMEMORY_BUDGET_RATIOを超えている間は、実行中のタスクを増やさない
+                return monitor.total_rss() > options.memory_budget * MEMORY_BUDGET_RATIO
+
+        with pool_class(options)(num_processes, initializer=init_worker, initargs=(channel, options)) as pool:
+            # --orderedでは先頭のタスクが遅いと後続の結果がバッファに溜まって投入が止まるので、未回収の上限を広げておく
+            max_pending = num_processes * (4 if options.ordered else 2)
+            for results in imap_bounded(pool, func, units, max_pending, throttle, ordered=options.ordered):
+                writer.put(results)
+            pool.close()
+            pool.join()
+
+    if options.rule_stats is not None and monitor.rule_stats.entries:
+        with open(options.rule_stats, "w") as fp:
+            fp.write(monitor.rule_stats.report())
+        logger.info("%s: rule stats written to %s", stage, options.rule_stats)
+
+
+class WorkUnit(NamedTuple):
+    # 並列ステージの1タスク。ファイル全体か、ファイルの[start, end)バイトの範囲(行の途中で始まる範囲は次の行から、
+    # endをまたぐ行は最後まで読む)
+    path: str
+    start: int = 0
+    end: int | None = None
+
+    @property
+    def size(self):
+        return (os.path.getsize(self.path) if self.end is None else self.end) - self.start
+
+
+def split_units(path, chunk_bytes=0):
+    # chunk_bytesより大きいファイルを、およそchunk_bytesずつの範囲に分ける
+    size = os.path.getsize(path)
+    if not chunk_bytes or size <= chunk_bytes:
+        return [WorkUnit(path)]
+    return [WorkUnit(path, start, min(start + chunk_bytes, size)) for start in range(0, size, chunk_bytes)]
+
+
+def read_unit_lines(unit, encoding="utf-8"):
+    # unitの範囲で始まる行をまとめて読んでデコードし、改行を除いた行のリストを返す
+    with open(unit.path, "rb") as fp:
+        start = unit.start
+        if start > 0:
+            # 範囲の直前の文字から読み、前の範囲で始まった行の残りを飛ばす
+            fp.seek(start - 1)
+            start += len(fp.readline()) - 1
+        if unit.end is None:
+            data = fp.read()
+        else:
+            data = fp.read(max(unit.end - start, 0))
+            if data and not data.endswith(b"\n"):
+                # endをまたぐ行は最後まで読む
+                data += fp.readline()
+
+    text = data.decode(encoding)
+    if "\r" in text:
+        # テキストモードで開いたときと同じく、\r\nと\rも改行として扱う
+        text = text.replace("\r\n", "\n").replace("\r", "\n")
+    lines = text.split("\n")
+    if lines[-1] == "":
+        lines.pop()
+    return lines
+
+
+@dataclass
+class Source:
+    # コーパスの種類ごとの設定。ファイルの探し方と1単位の処理(parse)だけを持ち、並列実行・チャンク分け・
+    # 書き出し・計測はrun_source()が共通で受け持つ。
+    #
+    # parse(unit, options, **params, **prepareの戻り値)はWorkUnitを受け取り、record_typeのレコードのiterableを返す。
+    # 処理した行数・採用数・バイト数はparseがworker_metricsに数える。
+    # ワーカーで呼ばれるので、SOURCESに登録したものをモジュールの読み込み時に作ること
+    name: str
+    subdir: str  # dataset/以下のディレクトリ
+    output: str  # 出力ファイル名
+    record_type: type
+    parse: Callable
+    logger: logging.Logger = logger
+    pattern: str = ""  # 対象のファイル名(re.search)
+    exclude: tuple = ()  # 対象外のファイル名
+    params: dict = field(default_factory=dict)
+    # prepare(units, options)はステージの最初に親プロセスで1回呼ばれ、parseに渡す引数をdictで返す
+    prepare: Callable | None = None
+    # 文が複数行にまたがるものは、--sampleで行の代わりにファイルを選ぶ
+    sample_files: bool = False
+    # 0より大きければ、ファイルをこのバイト数ずつの範囲に分けて並列に処理する(parseが範囲に対応していること)
+    chunk_bytes: int = 0
+    num_processes: int = 4
+
+    def discover(self, dirname):
+        files = []
+        for root, _dirs, filenames in os.walk(top=dirname):
+            for filename in filenames:
+                if filename not in self.exclude and re.search(self.pattern, filename):
+                    files.append(os.path.join(root, filename))
+        return sorted(files)
+
+
+SOURCES = {}
+
+
+def register_source(source):
+    SOURCES[source.name] = source
+    return source
+
+
+def run_unit(name, options, params, unit):
+    # ワーカーで1単位を処理する。ソースは名前で渡し、ワーカー側のSOURCESから引く
+    source = SOURCES[name]
+    records = list(source.parse(unit, options, **params))
+    # 同じ出力ファイルに違う形のレコードが混ざらないよう、parseがrecord_typeのレコードを返すことを単位ごとに先頭で確かめる
+    if records and type(records[0]) is not source.record_type:
+        raise TypeError(f"{name}: parse returned {type(records[0]).__name__}, expected {source.record_type.__name__}")
+    return records
+
+
+def run_source(source, dirname, output_dir, options=None, files=None):
+    # sourceのファイルをdirnameから探して(filesを渡すとその順に)並列に処理し、output_dir/source.outputに書き出す
+    options = options or PipelineOptions()
+
+    if files is None:
+        files = source.discover(dirname)
+        if source.sample_files:
+            files = [f for f in files if in_sample(os.path.relpath(f, dirname), options.sample)]
+        units = [unit for f in files for unit in split_units(f, source.chunk_bytes)]
+        source.logger.info("%s: %d files, %d units", dirname, len(files), len(units))
+    else:
+        # --downloadで取得の済んだものから順に処理する
+        files = (f for f in files if os.path.basename(f) not in source.exclude and re.search(source.pattern, os.path.basename(f)))
+        units = (unit for f in files for unit in split_units(f, source.chunk_bytes))
+        source.logger.info("%s: processing files as they are downloaded", dirname)
 
-    num_processes = 8
-    pool = Pool(num_processes)
+    params = dict(source.params)
+    if source.prepare is not None:
+        params.update(source.prepare(units, options))
 
-    files = []
-    for root, dirs, filenames in os.walk(top=dirname):
-        for filename in filenames:
-            files.append(os.path.join(root, filename))
+    func = functools.partial(run_unit, source.name, options, params)
+    run_parallel_stage(source.name, func, units, open_output(output_dir, source.output, options), source.num_processes, options)
 
-    proc_aozora_file_ = functools.partial(proc_aozora_file, token_limit=token_limit)
 
-    print("file num:", len(files))
+def parse_aozora_unit(unit, options, token_limit):
+    return proc_aozora_file(unit.path, token_limit=token_limit)
 
-    with open(output_file, "w") as wfp:
-        for results in pool.imap_unordered(proc_aozora_file_, files):
-            for r in results:
-                j = json.dumps(r, ensure_ascii=False)
-                wfp.write(j)
-                wfp.write("\n")
 
-        # 以下は上のfor loopで置き換えられたが、上の並列ループ処理はdebugしづらいのでこちらもコメントとして残しておく
-        # for root, dirs, files in os.walk(top=dirname):
-        #     for f in files:
-        #         filePath = os.path.join(root, f)
-        #         print(filePath)
-        #         r = proc_aozora_file(filePath, token_limit=token_limit)
-        #         for x in r:
-        #             j = json.dumps(x, ensure_ascii=False)
-        #             wfp.write(j)
-        #             wfp.write("\n")
+register_source(Source("shosi", "shosi_dataset", "shosi.json", TokenSentence, parse_aozora_unit, logger=aozora_logger,
+                       params={"token_limit": 11}, sample_files=True, num_processes=8))
+register_source(Source("aozora", "aozora_dataset", "aozora.json", TokenSentence, parse_aozora_unit, logger=aozora_logger,
+                       params={"token_limit": 32}, sample_files=True, num_processes=8))
 
 
-def proc_anthy_file(filename):
+def proc_anthy_lines(lines, filename, sample=None):
+    # 「読み 表記」または「番号 読み 表記」の行から文を作る。読みと表記は|で区切ったトークン列
     result = []
+    debug = anthy_logger.isEnabledFor(logging.DEBUG)
 
-    i = 0
-    for line in open(filename):
-        i += 1
+    for i, line in enumerate(lines, 1):
         if line.startswith("#"):
             continue
 
         line = line.rstrip()
 
+        if not in_sample(line, sample):
+            continue
+
         ss = line.split(" ")
         if len(ss) == 2:
-            read = ss[0]
-            surface = ss[1]
+            read, surface = ss
         elif len(ss) == 3:
-            read = ss[1]
-            surface = ss[2]
-            print(read)
-            print(surface)
-            print("---")
+            _, read, surface = ss
+            if debug:
+                anthy_logger.debug("3 columns: read=%s surface=%s", read, surface)
+        else:
+            anthy_logger.warning("%s:%d: expected 2 or 3 columns, skipping: %r", filename, i, line)
+            continue
 
         read = read.split("|")
         surface = surface.split("|")
 
         if len(read) != len(surface):
-            print(i, read, surface)
+            anthy_logger.warning("%s:%d: length mismatch, skipping: read=%s surface=%s", filename, i, read, surface)
+            continue
 
-        assert(len(read) == len(surface))
+        read = [x for x in read if x != ""]
+        surface = [x for x in surface if x != ""]
 
-        read = list(filter(lambda x: x != "", read))
-        surface = list(filter(lambda x: x != "", surface))
+        result.append(TokenSentence.from_tokens(surface, read))
 
-        print(read)
+    return result
 
-        sentence = {"surface": surface, "read": read}
-        result.append(sentence)
 
+def proc_anthy_file(filename, sample=None):
+    return parse_anthy_unit(WorkUnit(filename), PipelineOptions(sample=sample))
+
+
+def parse_anthy_unit(unit, options):
+    lines = read_unit_lines(unit)
+    result = proc_anthy_lines(lines, unit.path, options.sample)
+    worker_metrics.counters.update(lines=len(lines), accepted=len(result), bytes=unit.size)
+    worker_metrics.flush()
     return result
 
-def proc_anthy_dataset(dirname, output_dir, output_file):
-    os.makedirs(output_dir, exist_ok=True)
-    output_file = os.path.join(output_dir, output_file)
 
-    with open(output_file, "w") as wfp:
-        for root, dirs, files in os.walk(top=dirname):
-            for f in files:
-                # corpus.4.txtは変換誤りの記録なので、スキップする
-                if f == "corpus.4.txt":
-                    continue
-                if f.endswith(".txt"):
-                    filePath = os.path.join(root, f)
-                    print(filePath)
-                    r = proc_anthy_file(filePath)
-                    for x in r:
-                        j = json.dumps(x, ensure_ascii=False)
-                        wfp.write(j)
-                        wfp.write("\n")
+# corpus.4.txtは変換誤りの記録なので、スキップする
+register_source(Source("anthy", "anthy-corpus", "anthy.json", TokenSentence, parse_anthy_unit, logger=anthy_logger,
+                       pattern=r"\.txt$", exclude=("corpus.4.txt",)))
 
 
-def proc_cannadic_file(filename):
+# この読みの項目は使わない
+CANNADIC_SKIP_READS = {"きりるもじ", "ぎりしゃもじ"}
+
+
+def proc_cannadic_lines(lines, sample=None):
+    # 「読み #品詞*頻度 表記 表記 ... #品詞*頻度 表記 ...」の行から、表記ごとに項目を作る。
+    # 頻度は後ろの表記に引き継がれ、最初の#より前の表記は100になる
     result = []
+    debug = cannadic_logger.isEnabledFor(logging.DEBUG)
 
-    i = 0
-    for line in open(filename):
-        i += 1
+    for line in lines:
         if line.startswith("#"):
             continue
 
         line = line.rstrip()
 
-        print(line)
-        ss = line.split(" ")
+        if not in_sample(line, sample):
+            continue
 
-#        print(ss)
-        score = 100
+        ss = line.split(" ")
         read = ss[0]
+        if read in CANNADIC_SKIP_READS:
+            continue
 
         read = read.replace("あいのさときょいくだい", "あいのさときょういくだい")
 
+        n_entries = len(result)
+        score = 100
         for x in ss[1:]:
-            if x.startswith("#") and re.search(r".*\d+$", x):
-                print(x.split("*"))
+            # 数字で終わる#から始まる列(#T35*202など)は品詞と頻度
+            if x.startswith("#") and x[-1].isdecimal():
                 score = int(x.split("*")[1])
-                print("score:", score)
                 continue
 
-            surface = x
-
 #            if len(surface) >= 4:
 #                continue
 
-            if read in {"きりるもじ", "ぎりしゃもじ"}:
-                continue
+            result.append(DictEntry(x, read, score))
 
-            sentence = {"surface": surface, "read": read, "score": score}
-            print(sentence)
-            result.append(sentence)
+        if debug:
+            cannadic_logger.debug("line: %s entries: %s", line, result[n_entries:])
 
     return result
 
 
-def proc_alt_cannadic(dirname, output_dir, output_file):
-    os.makedirs(output_dir, exist_ok=True)
-    output_file = os.path.join(output_dir, output_file)
+def proc_cannadic_file(filename, sample=None):
+    return parse_cannadic_unit(WorkUnit(filename), PipelineOptions(sample=sample))
+
+
+def parse_cannadic_unit(unit, options):
+    lines = read_unit_lines(unit)
+    result = proc_cannadic_lines(lines, options.sample)
+    worker_metrics.counters.update(lines=len(lines), accepted=len(result), bytes=unit.size)
+    worker_metrics.flush()
+    return result
+
+
+# 辞書は1ファイルが大きいので、行の範囲に分けて並列に処理する
+register_source(Source("alt-cannadic", "alt-cannadic", "alt-cannadic.json", DictEntry, parse_cannadic_unit, logger=cannadic_logger,
+                       pattern=r"\.ctd$", chunk_bytes=1 << 20))
 
-    with open(output_file, "w") as wfp:
-        for root, dirs, files in os.walk(top=dirname):
-            for f in files:
-                if f.endswith(".ctd"):
-                    filePath = os.path.join(root, f)
-                    print(filePath)
-                    r = proc_cannadic_file(filePath)
-                    for x in r:
-                        j = json.dumps(x, ensure_ascii=False)
-                        wfp.write(j)
-                        wfp.write("\n")
 
+# 辞書は1つだけ読み込み、Tokenizerはスレッドごとに作る(Tokenizerは複数スレッドから同時に使えない)
+sudachi_dictionary = sudachidict.Dictionary(dict="full")
+sudachi_local = threading.local()
 
 
-sudachi_tokenizer = sudachidict.Dictionary(dict="full").create()
+def get_sudachi_tokenizer():
+    tokenizer = getattr(sudachi_local, "tokenizer", None)
+    if tokenizer is None:
+        tokenizer = sudachi_local.tokenizer = sudachi_dictionary.create()
+    return tokenizer
+
 
 def katakana_to_hiragana(text):
     # カタカナをひらがなに変換する
@@ -373,9 +784,13 @@ def parse_furigana_result(text):
     return "".join(r_surface), katakana_to_hiragana("".join(r_read))
 
 
+def ngram_order(filename):
+    # "3gm-0012" -> 3
+    return int(os.path.basename(filename)[0])
+
+
 def calc_freq_threshold(filename):
-    filename = os.path.basename(filename)
-    n = int(filename[0])
+    n = ngram_order(filename)
 
     if n == 1 or n == 2:
         return 500
@@ -385,285 +800,246 @@ def calc_freq_threshold(filename):
         return 200
 
 
-def parse_japanese_web_ngram_line(line, freq_threshold):
-    ngram, freq = line.split("\t")
+def _search(pattern, module=re):
+    search = module.compile(pattern).search
+    return lambda ngram, freq: search(ngram)
 
-    freq = int(freq)
-    if freq < freq_threshold:
-        return None
 
-    if re.search("[:|()（）「」【】『』><\[\]\"〔〕〇┃┣☆∪├←∟×↑└∩⊂“★◎●▶□△○│≪≫◇▲↓→»▼▽※■◆]", ngram):
-        return None
-
-    if re.search("、", ngram) and random.random() > 0.001:
-        return None
-
-    if regex.search("^(\p{hiragana}{1,2}|\p{katakana}{1})$", ngram):
-        return None
-
-    ngram = ngram.split(" ")
-
-    if ngram[0][0] in {"~", "(", ")", "/", ":", "'", "$", "&","+", "=", ";", "@", "?", ",", "#", "`", "%", "「", "『", "」", "』", "（", "）", "-", "、", "・", "〜", "*", "─", "〈", "《", "〉", "》", "”", "♪", "−", "⇒"}:
-        return None
-
-    ngram = "".join(ngram)
+def _join_ngram(ngram, freq):
+    ngram = "".join(ngram.split(" "))
 
     ngram = ngram.replace("<S>", "")
     ngram = ngram.replace("</S>", "")
+    return ngram
 
-    if freq < 2500 and re.search(r"^(たのは|たとき|のは|ときゃ|って|おきたい|たくて|たくない|たくは|たくなる|っ|して|うと)", ngram):
-        return None
 
-    if re.search(r'^[のはがをとにて][ア-ン][ーア-ン]+', ngram):
-        if random.random() > 0.05:
-            #                    print("skip", ngram)
-            return None
+_first_symbols = {"~", "(", ")", "/", ":", "'", "$", "&", "+", "=", ";", "@", "?", ",", "#", "`", "%",
+                  "「", "『", "」", "』", "（", "）", "-", "、", "・", "〜", "*", "─", "〈", "《", "〉", "》", "”", "♪", "−", "⇒"}
 
-    if regex.search(r'^(ちまった|かかった|なかった|ちゃった|はたった|でたった|たかった|にたった|のたった|れるって|かどっち|いねっと|もどっち|わくば).{0,2}', ngram):
-        return None
+_short_phrase_pattern = re.compile(r"^(たのは|たとき|のは|ときゃ|って|おきたい|たくて|たくない|たくは|たくなる|っ|して|うと)")
+_particle_katakana_pattern = re.compile(r'^[のはがをとにて][ア-ン][ーア-ン]+')
+_leading_zeros_pattern = re.compile("^00+(-*)[円人]")
+_high_freq_short_pattern = regex.compile(r"^(\p{Han}{1,4}|\p{hiragana}{1,4}|p{katakana}{1,4})$")
+_kana_han_pattern = regex.compile(r'^[たちさすぬねきくけこばびぶべぼぱぴぷぺぽパピプペポ]\p{Han}')
+_you_han_pattern = regex.compile(r'^用\p{Han}{2,}$')
+_you_words_pattern = re.compile(r'^用(務|宗|心|水|語|量|字|意)')
+_tou_pattern = regex.compile(r'^(\p{Han}|\p{Hiragana}|・|ー){2,}等$')
+_tou_words_pattern = re.compile(r'^[平同高中]等$')
 
-    if is_all_alphanumeric_hyphen(ngram):
-#        print("skip by is_all_alphanumeric_hyphen", ngram)
-        return None
-
-    if len(ngram) == 0:
-        return None
 
+def _reject_head_and_tail(ngram, freq):
     # 版画以外に"版"ではじまるngramは要らなさそう
     if len(ngram) > 1 and ngram[0] == "版" and ngram[1] != "画":
-        return None
+        return True
     # 以下の条件を満たすやつはあんま重要じゃなさそうなので確率的に省く
     elif len(ngram) > 4 and ngram[-1] in {"は", "が", "の", "と", "を"} and is_kanji_or_katakana(ngram[-2]):
         if random.random() > 0.05:
             #                    print("skip", ngram)
-            return None
+            return True
     # 以下の条件を満たすやつはあんま重要じゃなさそうなので確率的に省く
     elif len(ngram) > 2 and ngram[0] in {"は", "が", "の", "と", "を", "に"} and is_kanji_or_katakana(ngram[1]):
         if random.random() > 0.05:
             #                    print("skip", ngram)
-            return None
+            return True
     elif len(ngram) > 1 and ngram[-2] in {"を"}:
-        return None
+        return True
     elif ngram[-1] in {"/", ":", "-"}:
-        return None
+        return True
     # 以下はスパムの痕跡っぽいので捨てる
     elif "馬鹿冨" in ngram:
-        return None
+        return True
     # 以下はスパムの痕跡っぽいので捨てる
     elif "醴醴醴" in ngram:
-        return None
-
-    elif re.search("^00+(-*)[円人]", ngram):
-        return None
-
-    if ngram.startswith("v") or ngram.endswith("v") or ngram.startswith("w") or ngram.endswith("w"):
-        return None
-
-    # アルファベットが2文字以上入っていたら捨てる
-    if re.search(r"[A-Za-z]{2,}", ngram):
-        return None
-
-    # なくても変換精度に影響なさそうなものを捨てる
-    if regex.search(r"^[A-Za-z0-9-]+$", ngram):
-        return None
+        return True
 
-    # なくても変換精度に影響なさそうなものを捨てる
-    if regex.search(r"^\p{Han}[〜&%-]", ngram):
-        return None
+    elif _leading_zeros_pattern.search(ngram):
+        return True
+    return False
 
-    # なくても変換精度に影響なさそうなものを捨てる
-    if regex.search(r"^\p{Han}$", ngram):
-        return None
 
-    # なくても変換精度に影響なさそうなものを捨てる
+def _reject_high_freq_short(ngram, freq):
     if freq > 100000 and len(ngram) < 3:
-        return None
-    elif freq > 100000 and regex.search(r"^(\p{Han}{1,4}|\p{hiragana}{1,4}|p{katakana}{1,4})$", ngram):
-        return None
+        return True
+    elif freq > 100000 and _high_freq_short_pattern.search(ngram):
+        return True
+    return False
 
-    # なくても変換精度に影響なさそうなものを捨てる
-    if re.search(r'[^0-9]\d+$', ngram):
-        return None
 
+def _reject_same_chars(ngram, freq):
+    a = ngram[0]
+    return len(ngram) > 3 and all(c == a for c in ngram)
+
+
+# parse_japanese_web_ngram_lineの形態素解析より前の足切りルール。上から順に評価する。
+# "join"より前はスペース区切りのままのngramが対象。
+WEB_NGRAM_RULES = [
+    FilterRule("symbols", _search(r"[:|()（）「」【】『』><\[\]\"〔〕〇┃┣☆∪├←∟×↑└∩⊂“★◎●▶□△○│≪≫◇▲↓→»▼▽※■◆]")),
+    FilterRule("comma", lambda ngram, freq: "、" in ngram and random.random() > 0.001, fixed=True),
+    FilterRule("short_kana", _search(r"^(\p{hiragana}{1,2}|\p{katakana}{1})$", regex)),
+    FilterRule("first_symbol", lambda ngram, freq: ngram.split(" ")[0][0] in _first_symbols),
+    FilterRule("join", _join_ngram, rewrite=True),
+    FilterRule("short_phrase", lambda ngram, freq: freq < 2500 and _short_phrase_pattern.search(ngram)),
+    FilterRule("particle_katakana", lambda ngram, freq: _particle_katakana_pattern.search(ngram) and random.random() > 0.05, fixed=True),
+    FilterRule("broken_verb", _search(r'^(ちまった|かかった|なかった|ちゃった|はたった|でたった|たかった|にたった|のたった|'
+                                      r'れるって|かどっち|いねっと|もどっち|わくば).{0,2}', regex)),
+    FilterRule("alphanumeric_hyphen", lambda ngram, freq: is_all_alphanumeric_hyphen(ngram)),
+    FilterRule("empty", lambda ngram, freq: len(ngram) == 0),
+    FilterRule("head_and_tail", _reject_head_and_tail, fixed=True, after=("empty",)),
+    FilterRule("v_w_edge", lambda ngram, freq: ngram.startswith("v") or ngram.endswith("v") or ngram.startswith("w") or ngram.endswith("w")),
+    # アルファベットが2文字以上入っていたら捨てる
+    FilterRule("alphabets", _search(r"[A-Za-z]{2,}")),
     # なくても変換精度に影響なさそうなものを捨てる
-    if re.search(r'[&\"\'@:-]$', ngram):
-        return None
-
+    FilterRule("alphanumeric_only", _search(r"^[A-Za-z0-9-]+$", regex)),
+    FilterRule("han_symbol", _search(r"^\p{Han}[〜&%-]", regex)),
+    FilterRule("single_han", _search(r"^\p{Han}$", regex)),
+    FilterRule("high_freq_short", _reject_high_freq_short),
+    FilterRule("trailing_number", _search(r'[^0-9]\d+$')),
+    FilterRule("trailing_symbol", _search(r'[&\"\'@:-]$')),
     # 変なngramを捨てる
-    if regex.search(r'^[たちさすぬねきくけこばびぶべぼぱぴぷぺぽパピプペポ]\p{Han}', ngram) and "行" not in ngram:
-        return None
-
-    # 変なngramを捨てる
-    if regex.search(r'(と底|[てには]関)$', ngram):
-        return None
-
-    # 変なngramを捨てる
-    if regex.search(r'^[零〇一壱二弐三参四五六七八九拾]第', ngram):
-        return None
-
-    if re.search(r'^完全無料', ngram):
-        return None
-
-    if re.search(r'^一人一|一人一$', ngram):
-        return None
-
-    if re.search(r'^.(ホテル|旅館|温泉|銀行|医院|病院|美容室|女学院|女子大学|大学)$', ngram):
-        return None
-
-    if ngram == "御礼申上" or ngram == "御礼申し上":
-        return None
-
+    FilterRule("kana_han", lambda ngram, freq: _kana_han_pattern.search(ngram) and "行" not in ngram),
+    FilterRule("to_soko", _search(r'(と底|[てには]関)$', regex)),
+    FilterRule("number_dai", _search(r'^[零〇一壱二弐三参四五六七八九拾]第', regex)),
+    FilterRule("kanzen_muryou", _search(r'^完全無料')),
+    FilterRule("hitori_ichi", _search(r'^一人一|一人一$')),
+    FilterRule("one_char_facility", _search(r'^.(ホテル|旅館|温泉|銀行|医院|病院|美容室|女学院|女子大学|大学)$')),
+    FilterRule("orei_moushiage", lambda ngram, freq: ngram == "御礼申上" or ngram == "御礼申し上"),
     # 救うのが難しすぎるので捨てる
-    if re.search(r'^[12]人\d', ngram):
-        return None
-
-    if re.search(r'[なにをがはもで][一二三四五六七八0-9A-Za-z]+$', ngram):
-        return None
-
-    if re.search(r"年生.+", ngram):
-        return None
-
-    if re.search(r"^(題の|testtest)", ngram):
-        return None
-
-    if re.search(r"[^・](・|・・)$", ngram):
-        return None
-
-    if re.search(r"(・・・・|ーーー)", ngram):
-        return None
-
-    if re.search(r"^て\d$", ngram):
-        #            print("skip", ngram, read)
-        return None
-
-    if re.search(r"^ー", ngram):
-        return None
-
-    if re.search(r"(てい|てご|もい)$", ngram):
-        return None
-
-    if regex.search(r"^こと\p{han}.+", ngram):
-        return None
-
+    FilterRule("ninzu_number", _search(r'^[12]人\d')),
+    FilterRule("particle_number", _search(r'[なにをがはもで][一二三四五六七八0-9A-Za-z]+$')),
+    FilterRule("nensei", _search(r"年生.+")),
+    FilterRule("dai_no", _search(r"^(題の|testtest)")),
+    FilterRule("trailing_nakaguro", _search(r"[^・](・|・・)$")),
+    FilterRule("repeated_marks", _search(r"(・・・・|ーーー)")),
+    FilterRule("te_digit", _search(r"^て\d$")),
+    FilterRule("leading_choon", _search(r"^ー")),
+    FilterRule("tei_tego_moi", _search(r"(てい|てご|もい)$")),
+    FilterRule("koto_han", _search(r"^こと\p{han}.+", regex)),
     # 間に合う/間にあう 以外は捨てる
-    if re.search(r"^間に[^合あ][うっいわ]", ngram):
-        return None
-
-    if re.search(r"([^(寒|急|保|水|空)]冷|[^制防]御|[^次落]第)$", ngram):
-        return None
-
-    if re.search(r"[^(りん|たま|ごご)]ご$", ngram):
-        return None
-
-    if regex.search(r"[^(て|で|に|って|で|て|\p{Han})]はい$", ngram):
-        return None
+    FilterRule("mani", _search(r"^間に[^合あ][うっいわ]")),
+    FilterRule("rei_go_dai", _search(r"([^(寒|急|保|水|空)]冷|[^制防]御|[^次落]第)$")),
+    FilterRule("trailing_go", _search(r"[^(りん|たま|ごご)]ご$")),
+    FilterRule("trailing_hai", _search(r"[^(て|で|に|って|で|て|\p{Han})]はい$", regex)),
+    FilterRule("trailing_o", _search(r"[^(フェニックスの|だ|じゃ|ひとし)]お$")),
+    FilterRule("trailing_dei", _search(r"^.{2,}でい$")),
+    FilterRule("noo_sun_kaka", _search(r"(のお|住ん|かかっ)$")),
+    FilterRule("hiragana_ju", _search(r"\p{Hiragana}[住狂捕]$", regex)),
+    FilterRule("particle_hiragana", _search(r"^([えとうのを]|のを|のが|のに|のか|のお)\p{hiragana}{5,}", regex)),
+    FilterRule("to_onaji", _search(r"^(とおなじ|とおなか)", regex)),
+    FilterRule("na_hiragana", _search(r"^な[^いくか]\p{hiragana}{4,}", regex)),
+    FilterRule("repeated_words", _search(r"いない暦|お湯お湯お湯|あーあーあー|死ね死ね死ね|で美$")),
+    FilterRule("kaiin_touroku", _search(r"^(.{3,}会員登録|会員登録.{3,})$")),
+    FilterRule("login_muryou", _search(r"^(.+ログイン無料|ログイン無料.+)$")),
+    FilterRule("trackback", _search(r"^(.+トラックバック一覧|トラックバック一覧.+)$")),
+    FilterRule("toukou_comment", _search(r"^(.+投稿コメント|投稿コメント.+)$")),
+    FilterRule("ranking", _search(r"^(.+(ブログ|サイト)ランキング|(ブログ|サイト)ランキング.+)$")),
+    FilterRule("ranking_more", _search(r"ランキングをもっと見る")),
+    FilterRule("kunikuni", _search(r"くにくにくに")),
+    FilterRule("you_han", lambda ngram, freq: _you_han_pattern.search(ngram) and not _you_words_pattern.search(ngram)),
+    FilterRule("same_chars", _reject_same_chars, after=("empty",)),
+    FilterRule("souryou_muryou", lambda ngram, freq: freq < 2500 and "送料無料" in ngram),
+    # 単語の途中で切れてるやつを捨てる
+    FilterRule("cut_words", _search(r"^(都キャンペーン|ちぃ地球|貫光殺砲|先など|々|おさん|おさん[^ぽ])")),
+    FilterRule("nen_ho", _search(r"^年(法|[零〇一壱二弐三参四五六七八九拾]月)$")),
+    FilterRule("short_dots", _search(r'^.{1,2}・・・', regex)),
+    FilterRule("yaku", _search(r".{5,}[^予契制解条規節集確成特公誓密要]約$")),
+    FilterRule("tou", lambda ngram, freq: _tou_pattern.search(ngram) and not _tou_words_pattern.search(ngram)),
+    # if "龍" in ngram and "竜" in ngram:
+    #     return None
+]
 
-    if re.search(r"[^(フェニックスの|だ|じゃ|ひとし)]お$", ngram):
-        return None
+web_ngram_filter = FilterCascade("filter.", WEB_NGRAM_RULES)
 
-    if re.search(r"^.{2,}でい$", ngram):
-        return None
 
-    if re.search(r"(のお|住ん|かかっ)$", ngram):
-        return None
-
-    if regex.search(r"\p{Hiragana}[住狂捕]$", ngram):
-        return None
+# 仮名と長音だけのn-gramは、Sudachiを通さずにカタカナをひらがなにしたものを読みとする。
+# ゐゑゔゕゖヰヱヴヵヶと長音の連続は辞書側で読みが変わる(「ゐ」→「い」、「ーー」→「ー」など)ので対象外。
+# それ以外にも辞書に独自の読みを持つ仮名語(「すと」→「すとっ」など)があるため、結果が一致する保証はなく、
+# --kana-fast-pathを指定したときだけ使う。--verify-fast-pathで形態素解析の結果と突き合わせられる。
+KANA_NGRAM_PATTERN = re.compile(r"[ぁ-わをんァ-ワヲンー]+")
+kana_fast_path = False
+verify_fast_path = False
 
-    if regex.search(r"^([えとうのを]|のを|のが|のに|のか|のお)\p{hiragana}{5,}", ngram):
-        return None
 
-    if regex.search(r"^(とおなじ|とおなか)", ngram):
+def fast_path_reading(ngram):
+    if KANA_NGRAM_PATTERN.fullmatch(ngram) is None or "ーー" in ngram:
         return None
+    return jaconv.kata2hira(ngram)
 
-#    if regex.search(r"^と\p{hiragana}{3,}", ngram): and not re.search(r"^(とんでも|とって|とこ|とんぼ|とんねるず)", ngram):
-#        return None
 
-    if regex.search(r"^な[^いくか]\p{hiragana}{4,}", ngram):
-        return None
+def morpheme_reading(surface_, reading_form):
+    if re.match(r"^\d+$", surface_):
+        return surface_
+    elif re.match(r"^[A-Z]+$", surface_):
+        return surface_
+    elif reading_form == "キゴウ" and not regex.match(r"\p{han}+|きごう", surface_):
+        return surface_
+    else:
+        return jaconv.kata2hira(reading_form)
 
-    if re.search(r"いない暦|お湯お湯お湯|あーあーあー|死ね死ね死ね|で美$", ngram):
-        return None
 
-    if re.search(r"^(.{3,}会員登録|会員登録.{3,})$", ngram):
-        return None
+def tokenize_ngram(ngram):
+    worker_metrics.counters["tokenize_calls"] += 1
+    r = get_sudachi_tokenizer().tokenize(ngram, sudachipy.Tokenizer.SplitMode.C)
 
-    if re.search(r"^(.+ログイン無料|ログイン無料.+)$", ngram):
-        return None
-
-    if re.search(r"^(.+トラックバック一覧|トラックバック一覧.+)$", ngram):
-        return None
+    surface = []
+    read = []
+    for x in r:
+#        print(x)
+        surface_ = x.surface()
+        surface.append(surface_)
+        read.append(morpheme_reading(surface_, x.reading_form()))
 
-    if re.search(r"^(.+投稿コメント|投稿コメント.+)$", ngram):
-        return None
+    surface = "".join(surface)
+    read = "".join(read)
 
-    if re.search(r"^(.+(ブログ|サイト)ランキング|(ブログ|サイト)ランキング.+)$", ngram):
-        return None
+    #r = dict_reader.furigana(dbert_prediction)
+    #surface, read = parse_furigana_result(r)
 
-    if re.search(r"ランキングをもっと見る", ngram):
-        return None
+    if surface != ngram:
+        web_logger.debug("surface mismatch: orig: %s surface: %s r: %s", ngram, surface, r)
 
-    if re.search(r"くにくにくに", ngram):
-        return None
+    return surface, read
 
-    if regex.search(r'^用\p{Han}{2,}$', ngram):
-        if not re.search(r'^用(務|宗|心|水|語|量|字|意)', ngram):
-            return None
 
-    a = ngram[0]
-    if len(ngram) > 3 and all(c == a for c in ngram):
+def filter_japanese_web_ngram_line(line, freq_threshold, freq=None):
+    # freqは、read_web_ngram_blocks()でバイト列から読んであればそれを使う
+    if freq is None:
+        ngram, freq = line.split("\t")
+        freq = int(freq)
+    else:
+        ngram = line[:line.rfind("\t")]
+    ngram = web_ngram_filter(ngram, freq, freq_threshold)
+    if ngram is None:
         return None
+    worker_metrics.counters["filter_passed"] += 1
+    return ngram, freq
 
-    if freq < 2500 and re.search(r"送料無料", ngram):
-        return None
 
-    # 単語の途中で切れてるやつを捨てる
-    if re.search(r"^(都キャンペーン|ちぃ地球|貫光殺砲|先など|々|おさん|おさん[^ぽ])", ngram):
+def fast_path_ngram(ngram):
+    read = fast_path_reading(ngram) if kana_fast_path else None
+    if read is None:
         return None
 
-    if re.search(r"^年(法|[零〇一壱二弐三参四五六七八九拾]月)$", ngram):
-        return None
+    worker_metrics.counters["fast_path_hits"] += 1
+    if verify_fast_path:
+        expected = tokenize_ngram(ngram)
+        if expected != (ngram, read):
+            worker_metrics.counters["fast_path_mismatches"] += 1
+            web_logger.warning("fast path mismatch: %s fast: %s tokenizer: %s", ngram, read, expected[1])
+    return ngram, read
 
-    if regex.search(r'^.{1,2}・・・', ngram):
-        return None
 
-    if re.search(r".{5,}[^予契制解条規節集確成特公誓密要]約$", ngram):
+def parse_japanese_web_ngram_line(line, freq_threshold, freq=None):
+    r = filter_japanese_web_ngram_line(line, freq_threshold, freq)
+    if r is None:
         return None
+    ngram, freq = r
 
-    if regex.search(r'^(\p{Han}|\p{Hiragana}|・|ー){2,}等$', ngram):
-        if not re.search(r'^[平同高中]等$', ngram):
-            return None
+    surface, read = fast_path_ngram(ngram) or tokenize_ngram(ngram)
+    return finish_japanese_web_ngram(ngram, freq, surface, read)
 
-    # if "龍" in ngram and "竜" in ngram:
-    #     return None
-
-    r = sudachi_tokenizer.tokenize(ngram, sudachipy.Tokenizer.SplitMode.C)
-
-    surface = []
-    read = []
-    for x in r:
-#        print(x)
-        surface_ = x.surface()
-        reading_form = x.reading_form()
-        surface.append(surface_)
-        if re.match(r"^\d+$", surface_):
-            read.append(surface_)
-        elif re.match(r"^[A-Z]+$", surface_):
-            read.append(surface_)
-        elif reading_form == "キゴウ" and not regex.match(r"\p{han}+|きごう", surface_):
-            read.append(surface_)
-        else:
-            read.append(jaconv.kata2hira(reading_form))
-
-    surface = "".join(surface)
-    read = "".join(read)
-
-    #r = dict_reader.furigana(dbert_prediction)
-    #surface, read = parse_furigana_result(r)
-
-    if surface != ngram:
-        print("orig:", ngram, "surface:", surface, "r:", r)
 
+def finish_japanese_web_ngram(ngram, freq, surface, read):
+    # 形態素解析の結果(surface, read)に、アドホックな修正と最後の足切りをかける
     if "龍" in ngram:
         surface = surface.replace("竜", "龍")
 
@@ -795,7 +1171,7 @@ def parse_japanese_web_ngram_line(line, freq_threshold):
             read = read.replace("いちにちちゅう", "いちにちじゅう")
             read = read.replace("いちにちなか", "いちにちじゅう")
             read = read.replace("いちにっちゅうう", "いちにちじゅうあめ")
-            print("replaced:", surface, read)
+            web_logger.debug("replaced: %s %s", surface, read)
         elif re.search(r'一日中2', surface):
             read = read.replace("いちにち2", "いちにちじゅう2")
 
@@ -832,7 +1208,7 @@ def parse_japanese_web_ngram_line(line, freq_threshold):
     if re.search(r'^中[123][あ-んア-ン]$', surface):
         if re.search(r'^[123]$', read):
             read = "ちゅう" + read
-            print("ちゅう：", read)
+            web_logger.debug("ちゅう: %s", read)
 
     if re.search(r'中[123]', surface):
         # {"surface": "岐阜中2", "read": "ぎふ2"}のように、なぜか「中」のよみが消えるケースがある
@@ -1344,7 +1720,7 @@ def parse_japanese_web_ngram_line(line, freq_threshold):
         return None
 
 
-    r = {"surface": surface, "read": read, "freq": freq}
+    r = WebEntry(surface, read, freq)
     return r
 
 def count_kanji(s):
@@ -1356,67 +1732,60 @@ def count_kanji(s):
 
 score_pattern1 = re.compile(r"(新着|スタークラブ|ログインして|利用規約|特定商取引法|プライバシーポリシー|会員のみ|クリック|トラックバック|コメント|公開無料|リンクに追加|更新情報|取引法に基づく|ブロとも|へのトラック|へスキップ|無断転載|ブログ村|リンクフリー|マイリスト|お気に入りに.|このブログ|記事.トラック|さんのブログ|いるクレジットカード|ニュース遊都|パスワードを忘れた|ブログ管理|ページ(の)*(先頭|トップ).|ボタンを押して|メールアドレスを入力|保証するもの.|無料今すぐ)")
 
-def calc_score(x):
-    freq = x["freq"]
-    surface = x["surface"]
-    read = x["read"]
-
-    score = freq * (len(surface) ** 0.3333)
+def _score_search(pattern, module=regex):
+    search = module.compile(pattern).search
+    return lambda surface, read: search(surface)
 
-    if regex.search(r"[A-Za-z]・", surface):
-        score = score * 0.25
 
-    if regex.search(r"$[A-Za-z0-9]", surface):
-        score = score * 0.25
+_nobori_pattern = re.compile(r"上り")
+_agari_pattern = re.compile(r"あがり")
 
+# calc_scoreでスコアに掛ける係数。内側のリストはif/elifの連鎖で、最初に当たったものだけを適用する
+SCORE_RULES = [
+    [ScoreRule("alphabet_nakaguro", _score_search(r"[A-Za-z]・"), 0.25)],
+    [ScoreRule("dollar_alphanumeric", _score_search(r"$[A-Za-z0-9]"), 0.25)],
     # if regex.search(r"^(\p{Hiragana}{1,1}|\p{Katakana}{1,1})$", surface):
     #     score = (score / 1000) ** 0.5 * 1000
     #     score = score * 0.5
-    if regex.search(r"^(\p{Hiragana}|\p{Katakana}){1}$", surface):
-        score = score * 0.01
-    if regex.search(r"^(\p{Hiragana}|\p{Katakana}){2}$", surface):
-        score = score * 0.1
-    elif regex.search(r"^(\p{Hiragana}{3}|\p{Katakana}{3})$", surface):
-        score = score * 0.2
-    elif regex.search(r"^\p{Hiragana}{4,}$", surface):
-        score = score * 0.5
-    elif regex.search(r"^\p{Katakana}{4,}$", surface):
-        score = score * 0.33
-    elif regex.search(r"^(\p{Katakana}|ー){2,4}\p{Han}{1,3}$", surface):
-        score = score * 5
-
-    if regex.search(r"^\p{Han}{1,4}$", surface):
-        score = score * 5
-    elif regex.search(r"^\p{Han}は$", surface):
-        score = score * 5
-    elif regex.search(r"^\p{Han}{1,3}\p{katakana}{2,4}", surface):
-        score = score * 5
-    elif regex.search(r"^\p{Han}{1,4}(する|しい)$", surface):
-        score = score * 10
-    elif regex.search(r"^\p{Han}{3}す$", surface):
-        score = score * 5
-    elif regex.search(r"^\p{Han}{1,3}[にのをは]\p{Han}{1,3}$", surface):
-        score = score * 10
-    elif regex.search(r"^.{1,3}[にのを]\p{Han}.{1,3}$", surface):
-        score = score * 10
-    elif regex.search(r"^.{1,5}\p{hiragana}(点|天)$", surface):
-        score = score * 10
-    elif regex.search(r"^(文節|分節|以外|意外|制約|誓約|製薬|成約|返って|却って|帰って|同額|同学|旅|度|回避|会費|高速|拘束|行っ|言っ|紅顔|睾丸|厚顔|抗癌|炒め|痛め|傷め|いため|先頭|戦闘|銭湯|尖塔|試料|資料|飼料).{1,3}$", surface):
-        score = score * 5
-    elif regex.search(r"^組み換え|組み合わせ", surface):
-        score = score * 10
-    elif regex.search(r"^.{1,3}(至急|支給|至急|子宮|四球|始球|死球)$", surface):
-        score = score * 5
-    elif re.search(r"上り", surface) and re.search(r"あがり", read):
-        score = score * 0.1
-    elif re.search(r"読替え|読取り|読取る|読返し|[読振絞話乗駆飛取張投押落突書申差]込ん", surface):
-        score = score * 0.1
-
-    if score_pattern1.search(surface):
-        score = score * 0.1
-
-    if re.search(r"^(思います|お問い合わせ|思い|問い合わせ|人|中|下さい|ページ|ください)$", surface):
-        score = score * 0.1
+    [ScoreRule("kana_1", _score_search(r"^(\p{Hiragana}|\p{Katakana}){1}$"), 0.01)],
+    [
+        ScoreRule("kana_2", _score_search(r"^(\p{Hiragana}|\p{Katakana}){2}$"), 0.1),
+        ScoreRule("kana_3", _score_search(r"^(\p{Hiragana}{3}|\p{Katakana}{3})$"), 0.2),
+        ScoreRule("hiragana_4", _score_search(r"^\p{Hiragana}{4,}$"), 0.5),
+        ScoreRule("katakana_4", _score_search(r"^\p{Katakana}{4,}$"), 0.33),
+        ScoreRule("katakana_han", _score_search(r"^(\p{Katakana}|ー){2,4}\p{Han}{1,3}$"), 5),
+    ],
+    [
+        ScoreRule("han_1_4", _score_search(r"^\p{Han}{1,4}$"), 5),
+        ScoreRule("han_ha", _score_search(r"^\p{Han}は$"), 5),
+        ScoreRule("han_katakana", _score_search(r"^\p{Han}{1,3}\p{katakana}{2,4}"), 5),
+        ScoreRule("han_suru", _score_search(r"^\p{Han}{1,4}(する|しい)$"), 10),
+        ScoreRule("han_3_su", _score_search(r"^\p{Han}{3}す$"), 5),
+        ScoreRule("han_particle_han", _score_search(r"^\p{Han}{1,3}[にのをは]\p{Han}{1,3}$"), 10),
+        ScoreRule("particle_han", _score_search(r"^.{1,3}[にのを]\p{Han}.{1,3}$"), 10),
+        ScoreRule("ten", _score_search(r"^.{1,5}\p{hiragana}(点|天)$"), 10),
+        ScoreRule("homonym_prefix", _score_search(r"^(文節|分節|以外|意外|制約|誓約|製薬|成約|返って|却って|帰って|同額|同学|旅|度|回避|会費|高速|拘束|"
+                                                  r"行っ|言っ|紅顔|睾丸|厚顔|抗癌|炒め|痛め|傷め|いため|先頭|戦闘|銭湯|尖塔|試料|資料|飼料).{1,3}$"), 5),
+        ScoreRule("kumikae", _score_search(r"^組み換え|組み合わせ"), 10),
+        ScoreRule("shikyu", _score_search(r"^.{1,3}(至急|支給|至急|子宮|四球|始球|死球)$"), 5),
+        ScoreRule("nobori_agari", lambda surface, read: _nobori_pattern.search(surface) and _agari_pattern.search(read), 0.1),
+        ScoreRule("okurigana_omitted", _score_search(r"読替え|読取り|読取る|読返し|[読振絞話乗駆飛取張投押落突書申差]込ん", re), 0.1),
+    ],
+    [ScoreRule("boilerplate", lambda surface, read: score_pattern1.search(surface), 0.1)],
+    [ScoreRule("common_words", _score_search(r"^(思います|お問い合わせ|思い|問い合わせ|人|中|下さい|ページ|ください)$", re), 0.1)],
+]
+
+score_rules = ScoreChains("score.", SCORE_RULES)
+
+
+def calc_score(x):
+    freq = x.freq
+    surface = x.surface
+    read = x.read
+
+    score = freq * (len(surface) ** 0.3333)
+
+    score = score_rules.apply(score, surface, read)
 
     if score > 50000:
         score = ((score / 50000) ** 0.25) * 250
@@ -1436,65 +1805,244 @@ def calc_score(x):
     return int(score)
 
 
-def proc_japanese_web_ngram_file(filename):
+def sample_ngram_lines(filename, n_lines=20000, n_chunks=20):
+    # ファイル全体から均等に選んだn_chunks箇所で、続く行をまとめて読む
+    size = os.path.getsize(filename)
+    samples = []
+    with open(filename, "rb") as fp:
+        for k in range(n_chunks):
+            offset = size * k // n_chunks
+            fp.seek(offset)
+            if offset > 0:
+                fp.readline()
+            for _ in range(n_lines // n_chunks):
+                line = fp.readline()
+                if not line:
+                    break
+                ngram, freq = line.decode("utf-8").rstrip().split("\t")
+                samples.append((ngram, int(freq)))
+    return samples
+
+
+def proc_japanese_web_ngram_line(line, freq_threshold, freq=None):
+    # 1行分の処理(足切り・形態素解析・スコア)。採用しない行はNone
+    r = parse_japanese_web_ngram_line(line, freq_threshold, freq)
+    if r is None:
+        return None
+    score = calc_score(r)
+    if score < 20:
+        return None
+    return r._replace(score=score)
+
+
+# nwc2010のファイルの文字コード
+WEB_NGRAM_ENCODING = "utf-8"
+
+
+def read_web_ngram_blocks(fp, freq_threshold, block_size=1 << 20):
+    # バイナリで開いたweb n-gramのファイルを大きなブロック単位で読み、ブロックごとに
+    # (行数, バイト数, [(行, freq), ...]) を返す。リストに入るのはfreqがfreq_threshold以上の行だけ。
+    # freqはタブの後ろのバイト列からそのまま読み、閾値を下回る大半の行はデコードしない
+    rest = b""
+    while True:
+        block = fp.read(block_size)
+        if not block:
+            break
+        end = block.rfind(b"\n")
+        if end < 0:
+            rest += block
+            continue
+        lines = block[:end].split(b"\n")
+        lines[0] = rest + lines[0]
+        rest = block[end + 1:]
+        yield len(lines), len(block), _lines_over_threshold(lines, freq_threshold)
+
+    if rest:
+        yield 1, 0, _lines_over_threshold([rest], freq_threshold)
+
+
+def _lines_over_threshold(lines, freq_threshold):
+    kept = []
+    append = kept.append
+    for line in lines:
+        freq = int(line[line.rfind(b"\t") + 1:])
+        if freq >= freq_threshold:
+            append((line.decode(WEB_NGRAM_ENCODING).rstrip(), freq))
+    return kept
+
+
+def proc_japanese_web_ngram_file(filename, adaptive_filters=False, freq_thresholds=None, sample=None, seed=None):
     result = []
-    freq_threshold = calc_freq_threshold(filename)
+    freq_threshold = freq_thresholds[ngram_order(filename)] if freq_thresholds else calc_freq_threshold(filename)
+
+    if adaptive_filters:
+        before, after = web_ngram_filter.calibrate(sample_ngram_lines(filename), freq_threshold)
+        web_logger.debug("%s: filter order calibrated, estimated cost per line %.0fns -> %.0fns: %s",
+                         filename, before, after, " ".join(rule.name for rule in web_ngram_filter.rules))
+
+    progress = RateLimitedLogger(web_logger, level=logging.DEBUG)
+    counters = worker_metrics.counters
 
     i = 0
+    pos = 0
+    last_accepted = 0
 
-    for line in open(filename):
-        i += 1
+    # 閾値を下回る行は足切りの最初で捨てられ、乱数も使わないので、読むときに飛ばしても結果は変わらない。
+    # --rule-statsで計測するときは、閾値のルールの評価回数が変わらないよう全行を渡す
+    precheck_threshold = freq_threshold if web_ngram_filter.stats is None else 0
 
-        if i % 100000 == 0:
-            print(filename, i)
-           
-        line = line.rstrip()
+    with open(filename, "rb") as fp:
+        for n_lines, n_bytes, lines in read_web_ngram_blocks(fp, precheck_threshold):
+            for line, freq in lines:
+                if not in_sample(line, sample):
+                    continue
 
-        r = parse_japanese_web_ngram_line(line, freq_threshold)
+                if seed is not None:
+                    # 行ごとに乱数を初期化すると、処理の順番やワーカー数によらず同じ結果になる
+                    random.seed(f"{seed}:{line}")
 
-        if r:
-            score = calc_score(r)
-            if score < 20:
-                continue
-            r["score"] = score
-            result.append(r)
+                r = proc_japanese_web_ngram_line(line, freq_threshold, freq)
+                if r:
+                    result.append(r)
+
+            # カウンタはブロックごとにまとめて足す
+            counters.update(lines=n_lines, bytes=n_bytes, accepted=len(result) - last_accepted)
+            last_accepted = len(result)
+            worker_metrics.maybe_flush()
+
+            if (i + n_lines) // 100000 > i // 100000:
+                progress.log("%s: %d lines", filename, i + n_lines)
+            i += n_lines
+            pos += n_bytes
+
+    counters.update(bytes=os.path.getsize(filename) - pos, accepted=len(result) - last_accepted)
+    worker_metrics.flush()
 
     return result
 
-def proc_japanese_web_ngram_dataset(dirname, output_dir, output_file):
-    os.makedirs(output_dir, exist_ok=True)
-    output_file = os.path.join(output_dir, output_file)
-
-    files = []
-    for root, dirs, filenames in os.walk(top=dirname):
-        for filename in filenames:
-            if re.search(r"\dgm-\d\d\d\d", filename):
-#            if re.search(r"1gm-\d\d\d\d", filename):
-                files.append(os.path.join(root, filename))
-
-    num_processes = 4
-    pool = Pool(num_processes)
-
-    with open(output_file, "w") as wfp:
-        for results in pool.imap_unordered(proc_japanese_web_ngram_file, files):
-            for r in results:
-                j = json.dumps(r, ensure_ascii=False)
-                wfp.write(j)
-                wfp.write("\n")
-
-#                wfp.write(r)
-#                wfp.write("\n")
-
-    # with open(output_file, "w") as wfp:
-    #     for root, dirs, files in os.walk(top=dirname):
-    #         for f in files:
-    #             filePath = os.path.join(root, f)
-    #             print(filePath)
-    #             r = proc_japanese_web_ngram_file(filePath)
-    #             for x in r:
-    #                 j = json.dumps(x, ensure_ascii=False)
-    #                 wfp.write(j)
-    #                 wfp.write("\n")
+def reservoir_sample(iterable, k, rng):
+    # Algorithm L (Li, 1994)。iterableからk個を一様に選ぶ。読み飛ばす個数をまとめて決めるので乱数の呼び出しが少ない
+    it = iter(iterable)
+    reservoir = list(itertools.islice(it, k))
+    if len(reservoir) < k:
+        return reservoir
+
+    w = math.exp(math.log(rng.random()) / k)
+    while True:
+        skip = int(math.log(rng.random()) / math.log(1 - w))
+        item = next(itertools.islice(it, skip, None), None)
+        if item is None:
+            return reservoir
+        reservoir[rng.randrange(k)] = item
+        w *= math.exp(math.log(rng.random()) / k)
+
+
+# --target-entriesの見積もりで試す閾値の下限(calc_freq_threshold()の値に対する倍率)と、次数ごとのサンプル数
+MIN_THRESHOLD_SCALE = 0.1
+THRESHOLD_SAMPLE_SIZE = 20000
+
+
+def sample_web_ngram_file(filename, k=THRESHOLD_SAMPLE_SIZE, sample=None):
+    # 閾値を下限まで下げても残りうる行(freqが下限以上)からk行を選び、
+    # 閾値以外の足切りとスコアの足切りを通るかどうかを調べる。
+    # --sampleの指定があれば、本処理と同じく選ばれる行だけを数えて選ぶ。
+    # 戻り値は (n-gramの次数, 下限以上の行数, [(freq, 採用されるか), ...])
+    floor = calc_freq_threshold(filename) * MIN_THRESHOLD_SCALE
+    n_lines = 0
+
+    def candidates():
+        nonlocal n_lines
+        with open(filename, "rb") as fp:
+            for _, _, lines in read_web_ngram_blocks(fp, floor):
+                if sample is not None:
+                    lines = [x for x in lines if in_sample(x[0], sample)]
+                n_lines += len(lines)
+                yield from lines
+
+    samples = reservoir_sample(candidates(), k, random.Random(os.path.basename(filename)))
+    accepted = []
+    for line, freq in samples:
+        accepted.append((freq, proc_japanese_web_ngram_line(line, 0, freq) is not None))
+    return ngram_order(filename), n_lines, accepted
+
+
+def estimate_freq_thresholds(files, target_entries, num_processes, options):
+    # 次数ごとの閾値をcalc_freq_threshold()の値の定数倍に保ったまま、
+    # 出力件数の見積もりがtarget_entriesになる倍率を二分探索で求める
+    # 1つの次数のサンプル数がTHRESHOLD_SAMPLE_SIZE程度になるよう、ファイルに振り分ける
+    files_per_order = collections.Counter(ngram_order(f) for f in files)
+    tasks = [(f, math.ceil(THRESHOLD_SAMPLE_SIZE / files_per_order[ngram_order(f)]), options.sample) for f in files]
+    # ワーカーは並列ステージと同じように初期化する(スレッド実行では、前のステージでinstrument()された
+    # web_ngram_filterがスレッドごとのworker_metricsを参照するため)。channelは渡さないので、
+    # サンプリング中のルールの集計は--rule-statsのレポートに入らない
+    with pool_class(options)(num_processes, initializer=init_worker, initargs=(None, options)) as pool:
+        sampled = pool.starmap(sample_web_ngram_file, tasks)
+
+    base = {ngram_order(f): calc_freq_threshold(f) for f in files}
+    samples = []  # (次数, freq, 1サンプルが表す行数)
+    for order, n_lines, accepted in sampled:
+        for freq, ok in accepted:
+            if ok:
+                samples.append((order, freq, n_lines / len(accepted)))
+
+    def thresholds(scale):
+        return {order: max(1, round(t * scale)) for order, t in base.items()}
+
+    def estimate(scale):
+        t = thresholds(scale)
+        return sum(weight for order, freq, weight in samples if freq >= t[order])
+
+    lo, hi = MIN_THRESHOLD_SCALE, 1.0
+    while estimate(hi) > target_entries and hi < 1e6:
+        hi *= 2
+    if estimate(lo) < target_entries:
+        web_logger.warning("target of %d entries is above the estimate at the lowest thresholds (%d)", target_entries, estimate(lo))
+        hi = lo
+    for _ in range(40):
+        mid = math.sqrt(lo * hi)
+        if estimate(mid) > target_entries:
+            lo = mid
+        else:
+            hi = mid
+
+    result = thresholds(hi)
+    web_logger.info("frequency thresholds for %d entries: %s (estimated %d entries)",
+                    target_entries, " ".join(f"{order}gm={t}" for order, t in sorted(result.items())), estimate(hi))
+    return result
+
+
+def prepare_web_ngram(units, options):
+    # --target-entriesの指定があれば、全ファイルをサンプリングして閾値を決める
+    if not options.target_entries:
+        return {}
+    files = [unit.path for unit in units]
+    return {"freq_thresholds": estimate_freq_thresholds(files, options.target_entries, options.processes or 4, options)}
+
+
+def parse_web_ngram_unit(unit, options, freq_thresholds=None):
+    return proc_japanese_web_ngram_file(
+        unit.path,
+        adaptive_filters=options.adaptive_filters,
+        freq_thresholds=freq_thresholds,
+        sample=options.sample,
+        seed=options.seed,
+    )
+
+
+register_source(Source("web", "japanese-web-ngram", "nwn.json", WebEntry, parse_web_ngram_unit, logger=web_logger,
+                       pattern=r"\dgm-\d\d\d\d", prepare=prepare_web_ngram))
+
+
+def source_files(downloads, dirname, ordered=False):
+    # --downloadのとき、dirnameに展開されるアーカイブがあれば展開が済むまで待つ(ディレクトリから探す)。
+    # dirnameに取得するファイルがあれば、取得の済んだものから順に(orderedならタスクの順に)返すイテレータを返す
+    if downloads is None:
+        return None
+    archives = [t for t in downloads.tasks if t.extract == "zip" and os.path.join(t.extract_dir, os.path.basename(t.path).removesuffix(".zip")) == dirname]
+    for task in archives:
+        downloads.wait(task)
+    files = [t for t in downloads.tasks if t.extract != "zip" and os.path.dirname(t.path) == dirname]
+    return downloads.outputs(files, ordered=ordered) if files else None
 
 
 def main():
@@ -1547,15 +2095,88 @@ def main():
     arg_parser = ArgumentParser(add_help=False)
 
     arg_parser.add_argument("--output", default="dataset", type=str, help="output directory path")
+    arg_parser.add_argument("--format", default="jsonl", choices=OUTPUT_FORMATS, help="output file format")
+    arg_parser.add_argument("--compress", default="none", choices=COMPRESSIONS, help="compress output files in parallel blocks")
+    arg_parser.add_argument("--log-level", default="INFO", type=str, help='log level, optionally per stage (e.g. "INFO,web=DEBUG")')
+    arg_parser.add_argument("--metrics-file", default=None, type=str, help="periodically dump throughput metrics as JSON to this file")
+    arg_parser.add_argument("--rule-stats", default=None, type=str, help="count and time every filter/score rule and write a ranked report to this file")
+    arg_parser.add_argument("--adaptive-filters", action="store_true", help="reorder web n-gram filters per file by measured selectivity and cost")
+    arg_parser.add_argument("--kana-fast-path", action="store_true", help="read kana-only web n-grams without running Sudachi")
+    arg_parser.add_argument("--verify-fast-path", action="store_true", help="use the kana fast path and compare every hit against Sudachi")
+    arg_parser.add_argument("--executor", default="process", choices=("process", "thread"),
+                            help="run parallel stages in worker processes or in threads sharing one Sudachi dictionary")
+    arg_parser.add_argument("--processes", default=None, type=int, help="number of workers for parallel stages (default: per stage)")
+    arg_parser.add_argument("--memory-budget", default=None, type=parse_size,
+                            help='total RSS budget such as "16G"; sizes the worker count and throttles dispatch')
+    arg_parser.add_argument("--target-entries", default=None, type=int,
+                            help="pick web n-gram frequency thresholds from a sampling pre-pass to output about this many entries")
+    arg_parser.add_argument("--sample", default=None, type=parse_fraction,
+                            help="process a stable hash-selected fraction (0-1] of lines (web, anthy, cannadic) or files (aozora, shosi)")
+    arg_parser.add_argument("--seed", default=None, type=int, help="seed the random web n-gram rules per line so that output is reproducible")
+    arg_parser.add_argument("--profile", default=None, choices=PROFILERS, help="profile every stage including pool workers and write merged reports")
+    arg_parser.add_argument("--profile-dir", default="profile", type=str, help="directory for --profile reports")
+    arg_parser.add_argument("--ordered", action="store_true", help="write records in input order so that identical inputs give byte-identical files")
+    arg_parser.add_argument("--anthy", action="store_true", help="also process the Anthy corpus in dataset/anthy-corpus (corpus.4.txt is skipped)")
+    arg_parser.add_argument("--alt-cannadic", action="store_true", help="also process the alt-cannadic dictionary in dataset/alt-cannadic")
+    arg_parser.add_argument("--download", action="store_true", help="download the datasets in the background and process each file as soon as it is verified")
+    arg_parser.add_argument("--download-jobs", default=4, type=int, help="parallel downloads for --download")
+    arg_parser.add_argument("--max-pending-downloads", default=8, type=int, help="files downloaded (or downloading) but not yet picked up by a stage")
+    arg_parser.add_argument("--checksums", default=None, type=str, help="sha256sum-format file to verify --download files against")
+    arg_parser.add_argument("--ndl-base-url", default=download_dataset.NDL_BASE_URL, type=str,
+                            help="base URL of the aozora/shosi furigana corpus for --download")
+    arg_parser.add_argument("--nwc-filelist-url", default=download_dataset.NWC_FILELIST_URL, type=str,
+                            help="URL of the nwc2010 n-gram file list for --download")
     args = arg_parser.parse_args()
 
-    proc_aozora_dataset("dataset/shosi_dataset", args.output, "shosi.json")
-    proc_aozora_dataset("dataset/aozora_dataset", args.output, "aozora.json", token_limit=32)
-
-    #proc_anthy_dataset("dataset/anthy-corpus", args.output, "anthy.json")
-    #proc_alt_cannadic("dataset/alt-cannadic", args.output, "alt-cannadic.json")
-    
-    proc_japanese_web_ngram_dataset("dataset/japanese-web-ngram", args.output, "nwn.json")
+    if args.seed is not None and args.executor == "thread":
+        arg_parser.error("--seed cannot be combined with --executor thread")
+    if args.download and args.target_entries:
+        arg_parser.error("--target-entries needs every web n-gram file before processing and cannot be combined with --download")
+
+    configure_logging(args.log_level)
+    if args.ordered and args.seed is None:
+        logger.warning("--ordered without --seed: the random web n-gram rules still change nwn.json between runs")
+
+    options = PipelineOptions(
+        output_format=args.format,
+        compression=args.compress,
+        metrics_file=args.metrics_file,
+        rule_stats=args.rule_stats,
+        adaptive_filters=args.adaptive_filters,
+        kana_fast_path=args.kana_fast_path,
+        verify_fast_path=args.verify_fast_path,
+        executor=args.executor,
+        processes=args.processes,
+        memory_budget=args.memory_budget,
+        target_entries=args.target_entries,
+        sample=args.sample,
+        seed=args.seed,
+        profile=args.profile,
+        profile_dir=args.profile_dir,
+        ordered=args.ordered,
+    )
+
+    # --downloadでは、ステージの順(全国書誌、青空文庫、web n-gram)に取得しながら処理する
+    downloads = None
+    if args.download:
+        checksums = download_dataset.read_checksums(args.checksums) if args.checksums else None
+        tasks = download_dataset.dataset_tasks("dataset", args.ndl_base_url, args.nwc_filelist_url, checksums)
+        downloads = download_dataset.DownloadPipeline(tasks, args.max_pending_downloads, args.download_jobs)
+
+    # anthyとalt-cannadicはダウンロードの対象外なので、指定したときだけ処理する
+    stages = ["shosi", "aozora"]
+    if args.anthy:
+        stages.append("anthy")
+    if args.alt_cannadic:
+        stages.append("alt-cannadic")
+    stages.append("web")
+
+    with downloads or contextlib.nullcontext():
+        for name in stages:
+            source = SOURCES[name]
+            dirname = os.path.join("dataset", source.subdir)
+            with profile_stage(name, options) as stage_options:
+                run_source(source, dirname, args.output, stage_options, files=source_files(downloads, dirname, options.ordered))
 
 if __name__ == "__main__":
     main()
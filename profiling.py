@@ -0,0 +1,161 @@
+import cProfile
+import os
+import pstats
+import sys
+import threading
+import time
+from collections import Counter
+
+# --profileの実装。ワーカーのタスクをプロファイラ付きで実行し、ワーカーごとの結果をファイルに書き出しておき、
+# ステージの最後に親プロセスでまとめる。
+#
+# - "cprofile": cProfileで全関数の呼び出し回数と時間を取る(遅くなる)
+# - "sample": 一定間隔でスタックを取るだけなので、ほぼ元の速度で動く
+#
+# cProfileは呼び出し元と呼び出し先の組しか記録しないので、flame graph用のスタックはどちらのモードでもサンプリングで取る。
+
+PROFILERS = ("cprofile", "sample")
+
+
+def frame_label(code):
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    # 別スレッドから対象スレッドのスタックをinterval秒ごとに取り、"外側;...;内側"の形で数える
+    def __init__(self, interval=0.005):
+        self.interval = interval
+        self.stacks = Counter()
+        self.target = None
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def enable(self):
+        self.target = threading.get_ident()
+        self.stopping.clear()
+        self.thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+        self.thread.start()
+
+    def disable(self):
+        self.stopping.set()
+        self.thread.join()
+
+    def _run(self):
+        while not self.stopping.wait(self.interval):
+            frame = sys._current_frames().get(self.target)
+            stack = []
+            while frame is not None:
+                stack.append(frame_label(frame.f_code))
+                frame = frame.f_back
+            if stack:
+                self.stacks[";".join(reversed(stack))] += 1
+
+    def dump(self, path):
+        with open(path, "w", encoding="utf-8") as fp:
+            for stack, count in self.stacks.items():
+                fp.write(f"{stack} {count}\n")
+
+
+class Profiler:
+    # 1スレッド分のプロファイラ。dump()は累積の結果でファイルを上書きする
+    def __init__(self, mode, output_dir, name=None):
+        self.mode = mode
+        self.sampler = StackSampler()
+        self.profile = cProfile.Profile() if mode == "cprofile" else None
+        os.makedirs(output_dir, exist_ok=True)
+        self.path = os.path.join(output_dir, name or f"{os.getpid()}-{threading.get_ident()}")
+
+    def enable(self):
+        self.sampler.enable()
+        if self.profile is not None:
+            self.profile.enable()
+
+    def disable(self):
+        if self.profile is not None:
+            self.profile.disable()
+        self.sampler.disable()
+
+    def dump(self):
+        self.sampler.dump(self.path + ".collapsed")
+        if self.profile is not None:
+            self.profile.dump_stats(self.path + ".prof")
+
+    def run(self, func, *args):
+        self.enable()
+        try:
+            return func(*args)
+        finally:
+            self.disable()
+            self.dump()
+
+
+_local = threading.local()
+
+
+def run_profiled(mode, output_dir, func, item):
+    # ワーカーで1タスクをプロファイルしながら実行する。Poolのワーカーは終了時の処理を走らせずに終わるので、
+    # タスクごとにそのワーカーのそれまでの累積を書き出しておく
+    profiler = getattr(_local, "profiler", None)
+    if profiler is None:
+        profiler = _local.profiler = Profiler(mode, output_dir)
+    return profiler.run(func, item)
+
+
+def _files(dirname, suffix):
+    files = []
+    for root, _dirs, filenames in os.walk(top=dirname):
+        for filename in filenames:
+            if filename.endswith(suffix):
+                files.append(os.path.join(root, filename))
+    return sorted(files)
+
+
+def merge_stacks(dirname):
+    stacks = Counter()
+    for path in _files(dirname, ".collapsed"):
+        with open(path, encoding="utf-8") as fp:
+            for line in fp:
+                stack, count = line.rstrip("\n").rsplit(" ", 1)
+                stacks[stack] += int(count)
+    return stacks
+
+
+def sample_report(stacks, limit=40):
+    total = sum(stacks.values()) or 1
+    own = Counter()
+    inclusive = Counter()
+    for stack, count in stacks.items():
+        frames = stack.split(";")
+        own[frames[-1]] += count
+        for frame in set(frames):
+            inclusive[frame] += count
+
+    lines = [f"{total:,} samples"]
+    for title, counter in (("self", own), ("inclusive", inclusive)):
+        lines.append("")
+        lines.append(f"== top {limit} by {title} samples ==")
+        for frame, count in counter.most_common(limit):
+            lines.append(f"{count:>10,} {count / total:>7.1%}  {frame}")
+    return "\n".join(lines) + "\n"
+
+
+def write_report(dirname, title, limit=40):
+    # dirname以下のワーカーごとの結果をまとめ、report.txtとstacks.collapsedを書く。書いたファイルのリストを返す
+    stacks = merge_stacks(dirname)
+    stacks_path = os.path.join(dirname, "stacks.collapsed")
+    with open(stacks_path, "w", encoding="utf-8") as fp:
+        for stack, count in sorted(stacks.items()):
+            fp.write(f"{stack} {count}\n")
+
+    report_path = os.path.join(dirname, "report.txt")
+    with open(report_path, "w", encoding="utf-8") as fp:
+        fp.write(f"# {title} ({time.strftime('%Y-%m-%d %H:%M:%S')})\n\n")
+        prof_files = _files(dirname, ".prof")
+        if prof_files:
+            stats = pstats.Stats(*prof_files, stream=fp)
+            fp.write(f"== {len(prof_files)} profiles, sorted by cumulative time ==\n")
+            stats.sort_stats("cumulative").print_stats(limit)
+            fp.write("== sorted by internal time ==\n")
+            stats.sort_stats("tottime").print_stats(limit)
+        fp.write(sample_report(stacks, limit))
+    return [report_path, stacks_path]
@@ -0,0 +1,287 @@
+import re
+import threading
+from time import perf_counter_ns
+
+
+class FilterRule:
+    # test(ngram, freq)が真なら、その行を捨てる。
+    # rewrite=Trueのルールはngramを書き換えるもので、test(ngram, freq)の戻り値が新しいngramになる。
+    # fixed=Trueのルール(書き換えや乱数を使うもの)は並べ替えの対象にしない。
+    # afterには、このルールより前に評価されている必要があるルールの名前を並べる。
+    __slots__ = ("name", "test", "rewrite", "fixed", "after")
+
+    def __init__(self, name, test, rewrite=False, fixed=False, after=()):
+        self.name = name
+        self.test = test
+        self.rewrite = rewrite
+        self.fixed = fixed or rewrite
+        self.after = tuple(after)
+
+
+class FilterCascade:
+    def __init__(self, prefix, rules):
+        self.prefix = prefix
+        self.rules = list(rules)
+        self.stats = None
+        self._lock = threading.Lock()
+        self._compile()
+
+    def _compile(self):
+        # 名前とルールを1つのリストにして1回で差し替える。スレッド実行ではcalibrate()中にも
+        # 他のスレッドが評価しているので、名前とルールが別々に入れ替わると集計が別のルールに付く
+        self._plan = [(self.prefix + rule.name, rule.rewrite, rule.test) for rule in self.rules]
+
+    def instrument(self, stats):
+        self.stats = stats
+
+    def __call__(self, ngram, freq, freq_threshold):
+        if self.stats is not None:
+            return self._run_instrumented(ngram, freq, freq_threshold)
+
+        if freq < freq_threshold:
+            return None
+
+        for _, rewrite, test in self._plan:
+            if rewrite:
+                ngram = test(ngram, freq)
+            elif test(ngram, freq):
+                return None
+        return ngram
+
+    def _segments(self):
+        # 並べ替えられない(fixed)ルールで区切った区間のリスト。("fixed", i) か ("movable", [i, ...])
+        segments = []
+        for i, rule in enumerate(self.rules):
+            if rule.fixed:
+                segments.append(("fixed", i))
+            elif segments and segments[-1][0] == "movable":
+                segments[-1][1].append(i)
+            else:
+                segments.append(("movable", [i]))
+        return segments
+
+    def calibrate(self, samples, freq_threshold):
+        # samplesの(ngram, freq)で各ルールの棄却率とコストを測り、fixedなルールで区切られた区間の中で
+        # 「棄却率 / コスト」の大きい順に並べ替える。区間内のルールは副作用がないので、並べ替えても結果は変わらない。
+        # 乱数を使うルールは乱数の消費順が変わらないよう、ここでは評価しない。
+        with self._lock:
+            return self._calibrate(samples, freq_threshold)
+
+    def _calibrate(self, samples, freq_threshold):
+        segments = self._segments()
+        evaluated = [0] * len(self.rules)
+        rejected = [0] * len(self.rules)
+        elapsed = [0] * len(self.rules)
+
+        for ngram, freq in samples:
+            if freq < freq_threshold:
+                continue
+            for kind, index in segments:
+                if kind == "fixed":
+                    rule = self.rules[index]
+                    if rule.rewrite:
+                        ngram = rule.test(ngram, freq)
+                    continue
+
+                failed = set()
+                for i in index:
+                    rule = self.rules[i]
+                    if any(name in failed for name in rule.after):
+                        continue
+                    t = perf_counter_ns()
+                    r = rule.test(ngram, freq)
+                    elapsed[i] += perf_counter_ns() - t
+                    evaluated[i] += 1
+                    if r:
+                        rejected[i] += 1
+                        failed.add(rule.name)
+                if failed:
+                    break
+
+        def reject_prob(i):
+            return (rejected[i] + 0.5) / (evaluated[i] + 1)
+
+        def cost(i):
+            return max(elapsed[i] / evaluated[i], 1.0) if evaluated[i] else float("inf")
+
+        def expected_cost(order):
+            total = 0.0
+            survive = 1.0
+            for i in order:
+                if not self.rules[i].fixed and evaluated[i]:
+                    total += survive * cost(i)
+                    survive *= 1.0 - reject_prob(i)
+            return total
+
+        before = expected_cost(range(len(self.rules)))
+
+        order = []
+        for kind, index in segments:
+            if kind == "fixed":
+                order.append(index)
+                continue
+
+            names = {self.rules[i].name for i in index}
+            done = set()
+            remaining = list(index)
+            while remaining:
+                candidates = [i for i in remaining if all(name in done or name not in names for name in self.rules[i].after)]
+                best = max(candidates, key=lambda i: (reject_prob(i) / cost(i), -i))
+                remaining.remove(best)
+                order.append(best)
+                done.add(self.rules[best].name)
+
+        after = expected_cost(order)
+        self.rules = [self.rules[i] for i in order]
+        self._compile()
+        return before, after
+
+    def _run_instrumented(self, ngram, freq, freq_threshold):
+        stats = self.stats
+
+        t = perf_counter_ns()
+        rejected = freq < freq_threshold
+        stats.record(self.prefix + "freq_threshold", rejected, perf_counter_ns() - t)
+        if rejected:
+            return None
+
+        for name, rewrite, test in self._plan:
+            t = perf_counter_ns()
+            r = test(ngram, freq)
+            elapsed = perf_counter_ns() - t
+            if rewrite:
+                stats.record(name, False, elapsed)
+                ngram = r
+            else:
+                stats.record(name, bool(r), elapsed)
+                if r:
+                    return None
+        return ngram
+
+
+class ScoreRule:
+    # test(surface, read)が真ならスコアにfactorを掛ける
+    __slots__ = ("name", "test", "factor")
+
+    def __init__(self, name, test, factor):
+        self.name = name
+        self.test = test
+        self.factor = factor
+
+
+class ScoreChains:
+    # chainsはScoreRuleのリストのリスト。各リストはif/elifの連鎖で、最初に当たったルールだけを適用する
+    def __init__(self, prefix, chains):
+        self.prefix = prefix
+        self.chains = [list(chain) for chain in chains]
+        self.stats = None
+        self._plan = [[(rule.test, rule.factor) for rule in chain] for chain in self.chains]
+
+    def instrument(self, stats):
+        self.stats = stats
+
+    def apply(self, score, surface, read):
+        if self.stats is not None:
+            return self._apply_instrumented(score, surface, read)
+
+        for chain in self._plan:
+            for test, factor in chain:
+                if test(surface, read):
+                    score = score * factor
+                    break
+        return score
+
+    def _apply_instrumented(self, score, surface, read):
+        stats = self.stats
+        for chain in self.chains:
+            for rule in chain:
+                t = perf_counter_ns()
+                hit = bool(rule.test(surface, read))
+                stats.record(self.prefix + rule.name, hit, perf_counter_ns() - t)
+                if hit:
+                    score = score * rule.factor
+                    break
+        return score
+
+
+class TokenRule:
+    # 文のトークン列に対する正規化ルール。kindによってtableの意味が変わる。
+    #   "read_override":  {(表記, 読み): 読み} 表記と読みの組に当たったら読みを差し替える
+    #   "surface_map":    {表記: 表記} 表記を差し替える
+    #   "read_translate": str.maketrans()の表。when(表記, 読み)が真(whenがNoneなら常に)なら読みの文字を置き換える
+    #   "read_surface":   表記の集合か、表記全体に当たる正規表現。当たるか、when(表記, 読み)が真なら読みを表記と同じにする
+    __slots__ = ("name", "kind", "table", "when")
+
+    KINDS = ("read_override", "surface_map", "read_translate", "read_surface")
+
+    def __init__(self, name, kind, table=None, when=None):
+        if kind not in self.KINDS:
+            raise ValueError(f"unknown token rule kind: {kind}")
+        self.name = name
+        self.kind = kind
+        self.table = table
+        self.when = when
+
+
+def _compile_token_rule(rule):
+    # ルールを、表記のリストと読みのリストをその場で書き換える関数にする
+    table, when = rule.table, rule.when
+
+    if rule.kind == "read_override":
+        by_surface = {}
+        for (surface, read), new_read in table.items():
+            by_surface.setdefault(surface, {})[read] = new_read
+
+        def apply(surfaces, reads):
+            if by_surface.keys().isdisjoint(surfaces):
+                return
+            for i, surface in enumerate(surfaces):
+                overrides = by_surface.get(surface)
+                if overrides is not None:
+                    reads[i] = overrides.get(reads[i], reads[i])
+
+    elif rule.kind == "surface_map":
+        def apply(surfaces, reads):
+            if table.keys().isdisjoint(surfaces):
+                return
+            for i, surface in enumerate(surfaces):
+                surfaces[i] = table.get(surface, surface)
+
+    elif rule.kind == "read_translate":
+        # 置き換える文字を含まない読みは、str.translate()で新しい文字列を作らずにそのまま残す
+        search = re.compile("[" + re.escape("".join(map(chr, table))) + "]").search
+
+        def apply(surfaces, reads):
+            for i, read in enumerate(reads):
+                if search(read) and (when is None or when(surfaces[i], read)):
+                    reads[i] = read.translate(table)
+
+    else:
+        if isinstance(table, re.Pattern):
+            fullmatch = table.fullmatch
+            surface_set = frozenset()
+        else:
+            fullmatch = None
+            surface_set = frozenset(table or ())
+
+        def apply(surfaces, reads):
+            for i, surface in enumerate(surfaces):
+                if surface in surface_set or (fullmatch is not None and fullmatch(surface)) or (when is not None and when(surface, reads[i])):
+                    reads[i] = surface
+
+    return apply
+
+
+class TokenNormalizer:
+    # TokenRuleを上から順に、1文のトークン列(表記のリストと読みのリスト)にまとめて適用する。
+    # 正規化を足すときは、分岐を書く代わりにルールの表に項目を足す
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self._plan = [_compile_token_rule(rule) for rule in self.rules]
+
+    def __call__(self, surfaces, reads):
+        surfaces = list(surfaces)
+        reads = list(reads)
+        for apply in self._plan:
+            apply(surfaces, reads)
+        return surfaces, reads
@@ -0,0 +1,325 @@
+import hashlib
+import lzma
+import os
+import threading
+import time
+import zipfile
+from functools import partial
+from http.server import ThreadingHTTPServer
+
+import pytest
+
+import download_dataset
+import prepare_dataset
+from download_dataset import DownloadError, DownloadPipeline, DownloadTask, MirrorRequestHandler
+
+# download_dataset.pyを、MirrorRequestHandlerで手元のディレクトリを公開したサーバーに向けて動かす
+
+# no_backoffがtime.sleepを差し替えるので、サーバー側とテスト側で待つときはこちらを使う
+sleep = time.sleep
+
+
+class RecordingHandler(MirrorRequestHandler):
+    # 受け取ったリクエストを記録し、指定があれば応答を遅らせたり本文を途中で切ったりする
+    requests = []
+    active = 0
+    peak = 0
+    delay = 0.0
+    # パスごとの遅延。なければdelay
+    delays = {}
+    truncate = False
+    lock = threading.Lock()
+
+    def do_GET(self):
+        cls = type(self)
+        with cls.lock:
+            cls.requests.append(("GET", self.path, self.headers.get("Range")))
+            cls.active += 1
+            cls.peak = max(cls.peak, cls.active)
+        try:
+            sleep(cls.delays.get(self.path, cls.delay))
+            super().do_GET()
+        finally:
+            with cls.lock:
+                cls.active -= 1
+
+    def do_HEAD(self):
+        with type(self).lock:
+            type(self).requests.append(("HEAD", self.path, self.headers.get("Range")))
+        super().do_HEAD()
+
+    def copyfile(self, source, outputfile):
+        if type(self).truncate:
+            # Content-Lengthは全体のまま、半分だけ送って切る
+            data = source.read()
+            outputfile.write(data[:len(data) // 2])
+            return
+        super().copyfile(source, outputfile)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def mirror(tmp_path):
+    root = tmp_path / "mirror"
+    root.mkdir()
+
+    class Handler(RecordingHandler):
+        requests = []
+        active = 0
+        peak = 0
+        delays = {}
+        lock = threading.Lock()
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), partial(Handler, directory=str(root)))
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield root, f"http://127.0.0.1:{server.server_address[1]}", Handler
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+@pytest.fixture(autouse=True)
+def no_backoff(monkeypatch):
+    monkeypatch.setattr(download_dataset.time, "sleep", lambda seconds: None)
+
+
+def put(root, name, data):
+    path = root / name
+    path.write_bytes(data)
+    return hashlib.sha256(data).hexdigest()
+
+
+def payload(n, size=200_000):
+    return bytes((i * 7 + n) % 251 for i in range(size))
+
+
+def test_download_all_fetches_in_parallel(mirror, tmp_path):
+    root, url, handler = mirror
+    handler.delay = 0.2
+    for i in range(6):
+        put(root, f"{i}gm-0000", payload(i))
+    lzma_data = payload(9)
+    put(root, "9gm-0000.xz", lzma.compress(lzma_data))
+
+    out = tmp_path / "out"
+    tasks = [DownloadTask(f"{url}/{i}gm-0000", str(out / f"{i}gm-0000")) for i in range(6)]
+    tasks.append(DownloadTask(f"{url}/9gm-0000.xz", str(out / "9gm-0000.xz"), "xz"))
+    results = list(download_dataset.download_all(tasks, jobs=4, retries=0, timeout=10))
+
+    assert handler.peak > 1
+    assert sorted(task.url for task, _ in results) == sorted(task.url for task in tasks)
+    for i in range(6):
+        assert (out / f"{i}gm-0000").read_bytes() == payload(i)
+    assert (out / "9gm-0000").read_bytes() == lzma_data
+    assert not (out / "9gm-0000.xz").exists()
+
+
+def test_fetch_resumes_partial_file(mirror, tmp_path):
+    root, url, handler = mirror
+    data = payload(1)
+    digest = put(root, "1gm-0000", data)
+    path = tmp_path / "1gm-0000"
+    (tmp_path / "1gm-0000.part").write_bytes(data[:12345])
+
+    download_dataset.fetch(DownloadTask(f"{url}/1gm-0000", str(path), sha256=digest), retries=0, timeout=10)
+
+    assert handler.requests == [("GET", "/1gm-0000", "bytes=12345-")]
+    assert path.read_bytes() == data
+    assert not (tmp_path / "1gm-0000.part").exists()
+
+
+def test_fetch_resumes_after_truncated_response(mirror, tmp_path):
+    root, url, handler = mirror
+    data = payload(2)
+    put(root, "2gm-0000", data)
+    handler.truncate = True
+    path = tmp_path / "2gm-0000"
+    task = DownloadTask(f"{url}/2gm-0000", str(path))
+
+    with pytest.raises(DownloadError, match=f"got {len(data) // 2} of {len(data)} bytes"):
+        download_dataset.fetch(task, retries=0, timeout=10)
+    assert not path.exists()
+    assert (tmp_path / "2gm-0000.part").stat().st_size == len(data) // 2
+
+    handler.truncate = False
+    download_dataset.fetch(task, retries=0, timeout=10)
+    assert handler.requests[-1] == ("GET", "/2gm-0000", f"bytes={len(data) // 2}-")
+    assert path.read_bytes() == data
+
+
+def test_fetch_rejects_sha256_mismatch(mirror, tmp_path):
+    root, url, handler = mirror
+    put(root, "3gm-0000", payload(3))
+    path = tmp_path / "3gm-0000"
+    task = DownloadTask(f"{url}/3gm-0000", str(path), sha256="0" * 64)
+
+    with pytest.raises(DownloadError, match="sha256 mismatch"):
+        download_dataset.fetch(task, retries=2, timeout=10)
+    assert len(handler.requests) == 3
+    assert not path.exists()
+    assert not (tmp_path / "3gm-0000.part").exists()
+
+
+def test_run_task_skips_completed_files(mirror, tmp_path):
+    root, url, handler = mirror
+    put(root, "4gm-0000", payload(4))
+    put(root, "5gm-0000.xz", lzma.compress(payload(5)))
+    plain = DownloadTask(f"{url}/4gm-0000", str(tmp_path / "4gm-0000"))
+    xz = DownloadTask(f"{url}/5gm-0000.xz", str(tmp_path / "5gm-0000.xz"), "xz")
+    for task in (plain, xz):
+        download_dataset.run_task(task, retries=0, timeout=10)
+    assert len(handler.requests) == 2
+
+    # 取得済みのファイルと展開済みのxzは、リクエストを送らずに飛ばす
+    for task in (plain, xz):
+        assert download_dataset.run_task(task, retries=0, timeout=10) == task.output
+    assert len(handler.requests) == 2
+
+
+def test_run_task_verifies_unextracted_archive(mirror, tmp_path):
+    root, url, handler = mirror
+    archive = tmp_path / "src.zip"
+    with zipfile.ZipFile(archive, "w") as z:
+        z.writestr("aozora_dataset/a.txt", "あ")
+    data = archive.read_bytes()
+    put(root, "aozora_dataset.zip", data)
+    out = tmp_path / "out"
+    out.mkdir()
+    task = DownloadTask(f"{url}/aozora_dataset.zip", str(out / "aozora_dataset.zip"), "zip", str(out))
+
+    # 取得済みで展開前のzipは、HEADでリモートのサイズと比べて一致すればそのまま展開する
+    (out / "aozora_dataset.zip").write_bytes(data)
+    assert download_dataset.run_task(task, retries=0, timeout=10) == str(out)
+    assert handler.requests == [("HEAD", "/aozora_dataset.zip", None)]
+    assert (out / "aozora_dataset" / "a.txt").read_text() == "あ"
+
+    # 展開済みの印があれば何もしない
+    download_dataset.run_task(task, retries=0, timeout=10)
+    assert len(handler.requests) == 1
+
+    # サイズが合わなければ取り直してから展開する
+    os.remove(task.done_marker)
+    (out / "aozora_dataset.zip").write_bytes(data[:100])
+    download_dataset.run_task(task, retries=0, timeout=10)
+    assert handler.requests[1:] == [("HEAD", "/aozora_dataset.zip", None), ("GET", "/aozora_dataset.zip", None)]
+    assert (out / "aozora_dataset.zip").read_bytes() == data
+
+
+def web_tasks(root, url, out, n):
+    for i in range(n):
+        put(root, f"{i}gm-0000", payload(i, 20_000))
+    return [DownloadTask(f"{url}/{i}gm-0000", str(out / f"{i}gm-0000")) for i in range(n)]
+
+
+def gets(handler):
+    with handler.lock:
+        return sum(1 for method, _, _ in handler.requests if method == "GET")
+
+
+def run_with_timeout(func, timeout=10):
+    # 待ち合わせが詰まったときにテストごと止まらないよう、別スレッドで動かして時間を区切る
+    result = {}
+
+    def target():
+        try:
+            result["value"] = func()
+        except Exception as e:
+            result["error"] = e
+
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    thread.join(timeout)
+    assert not thread.is_alive(), "deadlocked"
+    if "error" in result:
+        raise result["error"]
+    return result["value"]
+
+
+def test_pipeline_limits_pending_downloads(mirror, tmp_path):
+    root, url, handler = mirror
+    tasks = web_tasks(root, url, tmp_path / "out", 8)
+
+    # 処理側がゆっくり受け取っても、取得を始めてまだ受け取られていないファイルはmax_pending個まで
+    excess = []
+    with DownloadPipeline(tasks, max_pending=2, jobs=4, retries=0, timeout=10) as downloads:
+        for consumed, _ in enumerate(downloads.outputs(tasks), 1):
+            sleep(0.1)
+            excess.append(gets(handler) - consumed)
+    assert max(excess) == 2
+    assert gets(handler) == len(tasks)
+
+
+def test_pipeline_ordered_outputs(mirror, tmp_path):
+    root, url, handler = mirror
+    tasks = web_tasks(root, url, tmp_path / "out", 4)
+    handler.delays = {"/0gm-0000": 0.5}
+
+    with DownloadPipeline(tasks, max_pending=4, jobs=4, retries=0, timeout=10) as downloads:
+        assert list(downloads.outputs(tasks, ordered=True)) == [task.output for task in tasks]
+
+    # orderedでなければ終わったものから返す
+    for task in tasks:
+        os.remove(task.output)
+    with DownloadPipeline(tasks, max_pending=4, jobs=4, retries=0, timeout=10) as downloads:
+        outputs = list(downloads.outputs(tasks))
+    assert sorted(outputs) == sorted(task.output for task in tasks)
+    assert outputs[-1] == tasks[0].output
+
+
+def test_pipeline_failed_download_releases_its_slot(mirror, tmp_path):
+    root, url, handler = mirror
+    out = tmp_path / "out"
+    tasks = [DownloadTask(f"{url}/missing", str(out / "missing"))] + web_tasks(root, url, out, 3)
+
+    # 失敗したファイルの枠は返されるので、max_pending=1でも残りの取得が進む
+    with DownloadPipeline(tasks, max_pending=1, jobs=2, retries=0, timeout=10) as downloads:
+        with pytest.raises(DownloadError, match="missing"):
+            run_with_timeout(lambda: downloads.wait(tasks[0]))
+        assert run_with_timeout(lambda: [downloads.wait(task) for task in tasks[1:]]) == [task.output for task in tasks[1:]]
+
+    # 処理側が順不同で受け取るときも、失敗はそのファイルの番で例外になる
+    for task in tasks[1:]:
+        os.remove(task.output)
+    with DownloadPipeline(tasks, max_pending=1, jobs=2, retries=0, timeout=10) as downloads:
+        with pytest.raises(DownloadError, match="missing"):
+            run_with_timeout(lambda: list(downloads.outputs(tasks)))
+
+
+def test_pipeline_close_stops_remaining_downloads(mirror, tmp_path):
+    root, url, handler = mirror
+    tasks = web_tasks(root, url, tmp_path / "out", 6)
+
+    # 途中で抜けても、振り分けのスレッドが止まり、残りのファイルは取得しない
+    downloads = DownloadPipeline(tasks, max_pending=1, jobs=2, retries=0, timeout=10)
+    with downloads:
+        assert downloads.wait(tasks[0]) == tasks[0].output
+    assert not downloads.thread.is_alive()
+    assert gets(handler) <= 2
+    assert not os.path.exists(tasks[-1].output)
+
+    # 始める前に閉じてもよい
+    run_with_timeout(DownloadPipeline(tasks, retries=0, timeout=10).close)
+
+
+def test_source_files_waits_for_archives(mirror, tmp_path):
+    root, url, handler = mirror
+    archive = tmp_path / "src.zip"
+    with zipfile.ZipFile(archive, "w") as z:
+        z.writestr("aozora_dataset/a.txt", "あ")
+    put(root, "aozora_dataset.zip", archive.read_bytes())
+    out = tmp_path / "out"
+    out.mkdir()
+    tasks = [DownloadTask(f"{url}/aozora_dataset.zip", str(out / "aozora_dataset.zip"), "zip", str(out))]
+    tasks += web_tasks(root, url, out / "web", 3)
+
+    with DownloadPipeline(tasks, max_pending=2, jobs=2, retries=0, timeout=10) as downloads:
+        # アーカイブだけのディレクトリは展開が済むまで待ち、返すファイルはない
+        assert prepare_dataset.source_files(downloads, str(out / "aozora_dataset"), ordered=True) is None
+        assert (out / "aozora_dataset" / "a.txt").read_text() == "あ"
+        files = prepare_dataset.source_files(downloads, str(out / "web"), ordered=True)
+        assert list(files) == [task.output for task in tasks[1:]]
+    assert prepare_dataset.source_files(None, str(out / "web")) is None
@@ -0,0 +1,16 @@
+import benchmark
+from prepare_dataset import SOURCES, PipelineOptions, run_source
+
+
+def count_lines(path):
+    with open(path, encoding="utf-8") as fp:
+        return sum(1 for _ in fp)
+
+
+def test_target_entries_with_sample(tmp_path):
+    # --sampleで入力の一部だけを処理しても、閾値はその部分集合から見積もるので出力はおよそ指定の件数になる
+    data = benchmark.generate(str(tmp_path / "data"), "web", scale=0.4, n_files=7)
+    for sample in (None, 0.5):
+        output = tmp_path / f"out-{sample}"
+        run_source(SOURCES["web"], data, str(output), PipelineOptions(target_entries=500, sample=sample, processes=2))
+        assert 400 <= count_lines(output / "nwn.json") <= 600